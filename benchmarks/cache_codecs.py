@@ -0,0 +1,98 @@
+"""
+Compare the Redis proc cache codecs: time to encode and decode a host's worth
+of proc records, encoded size, and (given a Redis URL) the memory Redis uses
+for the cached hash.
+
+    python benchmarks/cache_codecs.py --procs 200 --redis redis://localhost/15
+"""
+from __future__ import print_function
+
+import argparse
+import copy
+import timeit
+
+from vr.common.cache import JSONCodec, MsgpackCodec
+from vr.common.tests import FakeSupervisor
+
+
+def make_process_info(count):
+    """
+    Return 'count' records shaped like those in the test fixtures, with names
+    and log paths varied the way they are on a real host.
+    """
+    template = FakeSupervisor.process_info[
+        'node_example-v2-local-f96054b7-web-5003']
+    procs = []
+    for i in range(count):
+        data = copy.deepcopy(template)
+        name = 'app%d-v%d-prod-%08x-web-%d' % (
+            i % 40, i % 7, i * 7919, 5000 + i)
+        data.update(
+            name=name,
+            group=name,
+            logfile='/apps/procs/%s/log' % name,
+            stdout_logfile='/apps/procs/%s/log' % name,
+            stderr_logfile=(
+                '/var/log/supervisor/%s-stderr---supervisor-gL_lvl.log' % name
+            ),
+            pid=1000 + i,
+            statename='RUNNING',
+            state=20,
+            description='pid %d, uptime 16:05:53' % (1000 + i),
+        )
+        procs.append(data)
+    return procs
+
+
+def bench(codec, procs, number):
+    encoded = [codec.dumps(data) for data in procs]
+    encode = timeit.timeit(
+        lambda: [codec.dumps(data) for data in procs], number=number)
+    decode = timeit.timeit(
+        lambda: [codec.loads(raw) for raw in encoded], number=number)
+    size = sum(len(raw) for raw in encoded)
+    return encoded, encode / number, decode / number, size
+
+
+def redis_memory(client, key, procs, encoded):
+    client.delete(key)
+    client.hset(key, mapping=dict(
+        (data['name'], raw) for data, raw in zip(procs, encoded)))
+    try:
+        return client.memory_usage(key, samples=0)
+    finally:
+        client.delete(key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--procs', type=int, default=200)
+    parser.add_argument('--number', type=int, default=100)
+    parser.add_argument('--redis', help='Redis URL to measure memory with')
+    args = parser.parse_args()
+
+    client = None
+    if args.redis:
+        import redis
+        client = redis.StrictRedis.from_url(args.redis)
+
+    procs = make_process_info(args.procs)
+    print('%d procs, mean of %d runs' % (args.procs, args.number))
+    header = '%-8s %12s %12s %10s' % (
+        'codec', 'encode ms', 'decode ms', 'bytes')
+    if client:
+        header += ' %12s' % 'redis bytes'
+    print(header)
+    for codec in JSONCodec(), MsgpackCodec():
+        encoded, encode, decode, size = bench(codec, procs, args.number)
+        name = type(codec).__name__.replace('Codec', '').lower()
+        line = '%-8s %12.3f %12.3f %10d' % (
+            name, encode * 1000, decode * 1000, size)
+        if client:
+            key = 'bench_cache_codecs:' + name
+            line += ' %12d' % redis_memory(client, key, procs, encoded)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Compare serializing procs one at a time with as_json() against the bulk
+serializer in vr.common.serialize.
+
+    python benchmarks/proc_json.py --procs 5000
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import timeit
+
+from vr.common import serialize
+from vr.common.models import Host, Proc, CompactProc
+from vr.common.tests import FakeRPC
+
+from cache_codecs import make_process_info
+
+
+def per_proc(procs):
+    return '[' + ','.join(proc.as_json() for proc in procs) + ']'
+
+
+def bulk(procs):
+    out = io.StringIO()
+    serialize.dump(procs, out)
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--procs', type=int, default=5000)
+    parser.add_argument('--number', type=int, default=5)
+    args = parser.parse_args()
+
+    host = Host('somewhere', FakeRPC())
+    process_info = make_process_info(args.procs)
+    print('%d procs, mean of %d runs, backend %s' % (
+        args.procs, args.number,
+        'orjson' if serialize.orjson is not None else 'json'))
+    print('%-12s %12s %12s' % ('proc class', 'as_json us', 'bulk us'))
+    for cls in Proc, CompactProc:
+        procs = [cls(host, data) for data in process_info]
+        results = []
+        for f in per_proc, bulk:
+            elapsed = timeit.timeit(lambda: f(procs), number=args.number)
+            results.append(elapsed / args.number / args.procs * 1e6)
+        print('%-12s %12.3f %12.3f' % ((cls.__name__,) + tuple(results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Time Proc.parse_name and Proc.name_to_shortname over a working set of proc
+names, the way event listeners call them: the same names over and over.
+Compares the cached functions against parsing every time.
+
+    python benchmarks/proc_names.py --names 2000 --calls 200000
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import timeit
+
+from vr.common import models
+from vr.common.models import Proc
+
+
+def make_names(count):
+    return [
+        'app%d-v%d-prod-%08x-web-%d' % (i % 40, i % 7, i * 7919, 5000 + i)
+        for i in range(count)
+    ]
+
+
+def uncached(f):
+    """
+    Call f with the name caches emptied each time.
+    """
+    def call(name):
+        models._parsed_names.clear()
+        models._shortnames.clear()
+        return f(name)
+    return call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--names', type=int, default=2000)
+    parser.add_argument('--calls', type=int, default=200000)
+    args = parser.parse_args()
+
+    names = make_names(args.names)
+    stream = [random.choice(names) for _ in range(args.calls)]
+
+    print('%d calls over %d names' % (args.calls, args.names))
+    print('%-20s %12s %12s' % ('function', 'uncached us', 'cached us'))
+    for f in Proc.parse_name, Proc.name_to_shortname:
+        slow = uncached(f)
+        before = timeit.timeit(lambda: [slow(n) for n in stream], number=1)
+        after = timeit.timeit(lambda: [f(n) for n in stream], number=1)
+        print('%-20s %12.3f %12.3f' % (
+            f.__name__,
+            before / args.calls * 1e6,
+            after / args.calls * 1e6,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,13 @@
+import six
+
 import django.conf
 
 
+collect_ignore = []
+if six.PY2:
+    # asyncio support is Python 3 only
+    collect_ignore += ['vr/common/aio.py', 'vr/common/tests/test_aio.py']
+
+
 def pytest_configure():
     django.conf.settings.configure()
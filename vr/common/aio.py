@@ -0,0 +1,298 @@
+"""
+asyncio counterparts to the supervisor abstractions in vr.common.models.
+
+AsyncHost and AsyncProc have the same surface as Host and Proc, but their
+RPC and Redis methods are coroutines.  XML-RPC calls are made directly over
+asyncio streams, so thousands of them can be in flight on one event loop
+without a thread per host.
+
+Python 3 only.
+"""
+import asyncio
+import base64
+import logging
+import socket
+import time
+
+from six.moves import xmlrpc_client
+
+from vr.common import cache, models, rpc
+from vr.common.models import Proc, ProcError
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    # optional dependency
+    pass
+
+log = logging.getLogger(__name__)
+
+
+class AsyncServerProxy(object):
+    """
+    A minimal asyncio XML-RPC client.  Attribute access works as on
+    xmlrpc_client.ServerProxy, but calling a method returns a coroutine.
+
+    Each call is made on its own HTTP/1.0 connection, which supervisor closes
+    once it has sent the response.
+    """
+    def __init__(self, host, port, username=None, password=None,
+                 timeout=models.SUPERVISOR_RPC_TIMEOUT_SECS, path='/RPC2'):
+        self._host = host
+        self._port = port
+        self._path = path
+        self._timeout = timeout
+        self._auth = None
+        if username:
+            creds = ('%s:%s' % (username, password)).encode('utf-8')
+            self._auth = base64.b64encode(creds).decode('ascii')
+
+    def __repr__(self):
+        return '<AsyncServerProxy for %s:%s%s>' % (
+            self._host, self._port, self._path)
+
+    def __getattr__(self, name):
+        return _Method(self, name)
+
+    async def call(self, method, *params):
+        body = xmlrpc_client.dumps(params, method, allow_none=True)
+        body = body.encode('utf-8')
+        try:
+            return await asyncio.wait_for(self._request(body), self._timeout)
+        except asyncio.TimeoutError:
+            # Report it the way a blocking client would.
+            raise socket.timeout('timed out')
+
+    async def _request(self, body):
+        reader, writer = await asyncio.open_connection(self._host, self._port)
+        try:
+            headers = [
+                'POST %s HTTP/1.0' % self._path,
+                'Host: %s:%s' % (self._host, self._port),
+                'User-Agent: vr.common',
+                'Content-Type: text/xml',
+                'Content-Length: %d' % len(body),
+            ]
+            if self._auth:
+                headers.append('Authorization: Basic %s' % self._auth)
+            head = '\r\n'.join(headers) + '\r\n\r\n'
+            writer.write(head.encode('ascii') + body)
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        return self._parse_response(response)
+
+    def _parse_response(self, response):
+        head, _, body = response.partition(b'\r\n\r\n')
+        status_line, _, raw_headers = head.decode('latin-1').partition('\r\n')
+        _, status, reason = (status_line.split(' ', 2) + [''])[:3]
+        if status != '200':
+            url = '%s:%s%s' % (self._host, self._port, self._path)
+            raise xmlrpc_client.ProtocolError(
+                url, int(status or 0), reason, raw_headers)
+        # loads() raises xmlrpc_client.Fault for fault responses.
+        (result,), _ = xmlrpc_client.loads(body, use_builtin_types=True)
+        return result
+
+
+class _Method(object):
+    def __init__(self, proxy, name):
+        self._proxy = proxy
+        self._name = self.__name__ = name
+
+    def __getattr__(self, name):
+        return _Method(self._proxy, '%s.%s' % (self._name, name))
+
+    def __call__(self, *args):
+        return self._proxy.call(self._name, *args)
+
+
+async def _retry(policy, f, *args):
+    '''Await f(*args), retrying as the rpc.RetryPolicy allows, but sleeping
+    without blocking the event loop.'''
+    name = getattr(f, '__name__', f)
+    delays = policy.delays(time.time())
+    attempt = 0
+    while True:
+        try:
+            return await f(*args)
+        except policy.fatal:
+            raise
+        except Exception as exc:
+            delay = next(delays, None)
+            if delay is None:
+                log.error('%s permanently failed with %r', name, exc)
+                raise
+            log.warning('%s attempt #%d failed with %r', name, attempt, exc)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+class AsyncHost(object):
+    """
+    An asyncio version of Host, taking the same arguments.  get_proc() and
+    get_procs() are coroutines returning AsyncProc objects.
+
+    rpc_or_port may be a port number or an object whose methods return
+    awaitables, like AsyncServerProxy.  redis_or_url may be a Redis URL or a
+    redis.asyncio client.
+
+    Retries and the circuit breaker are shared with Host.  Cached procs are
+    read and written with cache_codec, as on Host; all readers of a cache
+    key must be able to read a codec's records before any writer uses it.
+    """
+    retry_policy = models.Host.retry_policy
+    circuit_breaker = models.Host.circuit_breaker
+
+    def __init__(self, name, rpc_or_port=9001, supervisor_username=None,
+                 supervisor_password=None, redis_or_url=None,
+                 redis_cache_prefix='host_procs', redis_cache_lifetime=600,
+                 rpc_timeout=models.SUPERVISOR_RPC_TIMEOUT_SECS,
+                 cache_codec=None):
+        self.name = name
+        self.username = supervisor_username
+        self.password = supervisor_password
+        self.rpc_timeout = rpc_timeout
+
+        self._init_supervisor_rpc(rpc_or_port)
+        self.redis = self._init_redis(redis_or_url)
+        self.cache_key = ':'.join([redis_cache_prefix, name])
+        self.cache_lifetime = redis_cache_lifetime
+        self.cache_codec = cache_codec or cache.JSONCodec()
+
+    def _init_supervisor_rpc(self, rpc_or_port):
+        if isinstance(rpc_or_port, int):
+            self.rpc = AsyncServerProxy(
+                self.name, rpc_or_port, self.username, self.password,
+                timeout=self.rpc_timeout)
+        else:
+            self.rpc = rpc_or_port
+        self.supervisor = self.rpc.supervisor
+
+    @staticmethod
+    def _init_redis(redis_spec):
+        if not redis_spec:
+            return
+        if isinstance(redis_spec, str):
+            return aioredis.StrictRedis.from_url(redis_spec)
+        return redis_spec
+
+    shortname = models.Host.shortname
+    __repr__ = models.Host.__repr__
+
+    async def get_proc(self, name, check_cache=False):
+        if check_cache:
+            cached = await self.redis.hget(self.cache_key, name)
+            if cached:
+                return AsyncProc(self, self.cache_codec.loads(cached))
+        procs_dict = await self._get_and_cache_procs()
+
+        if name in procs_dict:
+            return AsyncProc(self, procs_dict[name])
+        else:
+            raise ProcError('host %s has no proc named %s' % (self.name, name))
+
+    async def _call(self, f, *args):
+        self.circuit_breaker.allow(self.name)
+        try:
+            result = await _retry(self.retry_policy, f, *args)
+        except Exception as exc:
+            self.circuit_breaker.record_failure(self.name, exc)
+            raise
+        self.circuit_breaker.record_success(self.name)
+        return result
+
+    async def _get_and_cache_procs(self):
+        try:
+            return await self._fetch_and_cache_procs()
+        except rpc.CircuitOpen as exc:
+            log.warning("Not connecting to %s: %s", self, exc)
+            return {}
+        except Exception:
+            log.exception("Failed to connect to %s", self)
+            return {}
+
+    async def _fetch_and_cache_procs(self):
+        proc_list = await self._call(self.supervisor.getAllProcessInfo)
+
+        proc_dict = {d['name']: d for d in proc_list}
+        if self.redis:
+            dumps = self.cache_codec.dumps
+            dumped = {d: dumps(proc_dict[d]) for d in proc_dict}
+            async with self.redis.pipeline() as pipe:
+                pipe.delete(self.cache_key)
+                if dumped:
+                    pipe.hset(self.cache_key, mapping=dumped)
+                pipe.expire(self.cache_key, self.cache_lifetime)
+                await pipe.execute()
+
+        return proc_dict
+
+    async def get_procs(self, check_cache=False, raise_errors=False):
+        if raise_errors:
+            fetch = self._fetch_and_cache_procs
+        else:
+            fetch = self._get_and_cache_procs
+
+        all_data = None
+        if check_cache:
+            unparsed = await self.redis.hgetall(self.cache_key)
+            if unparsed:
+                loads = self.cache_codec.loads
+                all_data = {
+                    name: loads(raw) for name, raw in unparsed.items()}
+        if all_data is None:
+            all_data = await fetch()
+
+        return [AsyncProc(self, all_data[d]) for d in all_data]
+
+
+class AsyncProc(Proc):
+    """
+    A Proc whose supervisor control methods are coroutines.
+    """
+
+    @property
+    def settings(self):
+        raise AttributeError('Use "await proc.get_settings()" instead')
+
+    async def get_settings(self):
+        settings = self.cached_settings(self.host.name, self.name)
+        if settings is None:
+            settings = self.cache_settings(
+                self.host.name, self.name,
+                await self.host.rpc.vr.get_velociraptor_info(self.name))
+        return settings
+
+    async def start(self):
+        try:
+            await self.host.supervisor.startProcess(self.name)
+        except xmlrpc_client.Fault as f:
+            # Supervisor puts the proc name after the code.
+            if f.faultString.split(':')[0] == 'ALREADY_STARTED':
+                log.warning("Process %s already started", self.name)
+            else:
+                log.exception("Failed to start %s", self.name)
+                raise
+        except Exception:
+            log.exception("Failed to start %s", self.name)
+            raise
+
+    async def stop(self):
+        try:
+            await self.host.supervisor.stopProcess(self.name)
+        except xmlrpc_client.Fault as f:
+            # Supervisor puts the proc name after the code.
+            if f.faultString.split(':')[0] == 'NOT_RUNNING':
+                log.warning("Process %s not running", self.name)
+            else:
+                log.exception("Failed to stop %s", self.name)
+                raise
+        except Exception:
+            log.exception("Failed to stop %s", self.name)
+            raise
+
+    async def restart(self):
+        await self.stop()
+        await self.start()
@@ -0,0 +1,183 @@
+"""
+In-process caching in front of the Redis proc cache, and the codecs used to
+store proc records in Redis.
+"""
+import collections
+import json
+import logging
+import threading
+import time
+
+import six
+
+try:
+    import msgpack
+except ImportError:
+    # optional dependency
+    pass
+
+log = logging.getLogger(__name__)
+
+
+class LocalCache(object):
+    """
+    A small thread-safe in-process cache with a size bound, LRU eviction and
+    a time to live.
+
+    Entries younger than 'ttl' seconds are fresh.  Entries up to 'stale_ttl'
+    seconds older than that are stale: lookup() still returns them, and
+    callers are expected to serve them while one background refresh (see
+    revalidate()) replaces them.  Older entries are dropped.
+
+    A single LocalCache is meant to be shared by all the Host objects in a
+    process, e.g. as a module global in a web app.
+    """
+    def __init__(self, max_size=1024, ttl=2, stale_ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # key -> (value, time stored), least recently used first
+        self._data = collections.OrderedDict()
+        self._refreshing = set()
+
+    def __len__(self):
+        return len(self._data)
+
+    def lookup(self, key):
+        """
+        Return a (value, fresh) pair for key, or (None, False) on a miss.
+        """
+        with self._lock:
+            try:
+                value, stored = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None, False
+            age = time.time() - stored
+            if age > self.ttl + self.stale_ttl:
+                self.misses += 1
+                return None, False
+            # Reinsert as most recently used.
+            self._data[key] = value, stored
+            fresh = age <= self.ttl
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+            return value, fresh
+
+    def get(self, key):
+        """
+        Return the fresh value for key, or None.
+        """
+        value, fresh = self.lookup(key)
+        return value if fresh else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value, time.time()
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def revalidate(self, key, refresh):
+        """
+        Call refresh() in a background thread to replace a stale entry,
+        unless a refresh for key is already running.  Return True if a
+        refresh was started.
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                refresh()
+            except Exception:
+                log.exception("Failed to refresh %s", key)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=run, name='revalidate %s' % key)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class JSONCodec(object):
+    """
+    Store each proc record as a JSON document.  The default, and what older
+    versions of vr.common wrote.
+    """
+    def dumps(self, data):
+        return json.dumps(data)
+
+    def loads(self, raw):
+        return json.loads(raw)
+
+
+class MsgpackCodec(object):
+    """
+    Store each proc record as a version byte followed by msgpack.
+
+    Version 1 packs the values of the fields supervisor always returns as an
+    array in a fixed order, so the field names aren't stored with every
+    record, followed by a map of any other keys.
+
+    Records written by JSONCodec are still read, so a cache can be switched
+    over without being flushed.  Binary values need a Redis client created
+    without decode_responses.
+    """
+    version = b'\x01'
+
+    fields = (
+        'name', 'group', 'description', 'start', 'stop', 'now', 'state',
+        'statename', 'spawnerr', 'exitstatus', 'logfile', 'stdout_logfile',
+        'stderr_logfile', 'pid',
+    )
+    _field_set = frozenset(fields)
+
+    def dumps(self, data):
+        values = [data.get(field) for field in self.fields]
+        extra = {
+            key: value
+            for key, value in data.items()
+            if key not in self._field_set
+        }
+        values.append(extra)
+        return self.version + msgpack.packb(values, use_bin_type=True)
+
+    def loads(self, raw):
+        if isinstance(raw, six.text_type) or raw[:1] != self.version:
+            # Written by JSONCodec
+            return json.loads(raw)
+        values = msgpack.unpackb(raw[1:], raw=False)
+        extra = values.pop()
+        data = dict(zip(self.fields, values))
+        data.update(extra)
+        return data
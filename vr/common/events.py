@@ -0,0 +1,489 @@
+"""
+Reading the Velociraptor event stream, a server-sent events (SSE) feed.
+
+EventStream reconnects after errors, resuming from the last event seen, and
+can drop unwanted events before spending time decoding their JSON.  Events
+are read on a background thread into a bounded queue, so a slow consumer
+has an explicit choice between applying backpressure and losing events.
+
+EventHub shares one EventStream among many subscribers in a process.
+"""
+import json
+import logging
+import threading
+import time
+
+import requests
+from six.moves import queue
+
+from vr.common import rpc
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait for a connection, and for any data (even a keep-alive
+# comment) on it before giving up and reconnecting.  The read timeout should
+# be a bit longer than the server's keep-alive interval, so that a half-open
+# connection is noticed instead of waited on forever.
+DEFAULT_TIMEOUT = (10, 60)
+
+
+class Event(object):
+    """
+    One server-sent event.  'data' is the raw text; json() decodes it, once.
+    """
+    __slots__ = ('id', 'event', 'data', '_json')
+
+    def __init__(self, id=None, event='message', data=''):
+        self.id = id
+        self.event = event
+        self.data = data
+
+    def json(self):
+        try:
+            return self._json
+        except AttributeError:
+            self._json = json.loads(self.data)
+            return self._json
+
+    def __repr__(self):
+        return '<Event %s id=%s>' % (self.event, self.id)
+
+
+def parse_lines(lines, on_retry=None):
+    """
+    Yield an Event for each event in the lines of an SSE stream.  A 'retry'
+    field is passed to on_retry, in seconds.
+
+    >>> events = parse_lines(['id: 1', 'data: {"a":', 'data: 1}', ''])
+    >>> [(e.id, e.event, e.json()) for e in events]
+    [('1', 'message', {'a': 1})]
+    """
+    event_id = None
+    event_type = 'message'
+    data = []
+    for line in lines:
+        if not line:
+            if data:
+                yield Event(event_id, event_type, '\n'.join(data))
+            event_type = 'message'
+            data = []
+            continue
+        if line.startswith(':'):
+            # A comment, used as a keep-alive
+            continue
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'data':
+            data.append(value)
+        elif field == 'event':
+            event_type = value
+        elif field == 'id' and '\0' not in value:
+            event_id = value
+        elif field == 'retry' and value.isdigit() and on_retry:
+            on_retry(int(value) / 1000.0)
+
+
+class EventFilter(object):
+    """
+    Decide which events to keep, as cheaply as possible:
+
+    - event_types: SSE event types to keep.
+    - tags: keep events whose 'tags' include any of these, such as an app
+      name.  Events that don't contain any of the tags anywhere in their
+      raw text are dropped without being decoded.
+    - match: a function taking the raw Event, returning whether to keep it.
+
+    >>> keep = EventFilter(tags=['app1'])
+    >>> keep(Event(data='{"tags": ["app1"]}')), keep(Event(data='{}'))
+    (True, False)
+    """
+    def __init__(self, event_types=None, tags=None, match=None):
+        self.event_types = frozenset(event_types) if event_types else None
+        self.tags = frozenset(tags) if tags else None
+        self.match = match
+        # Non-ASCII tags may be escaped in the JSON, so can only be looked
+        # for once it's decoded.
+        self._tag_prefilter = self.tags is not None and all(
+            _is_ascii(tag) for tag in self.tags)
+
+    def __call__(self, event):
+        event_types = self.event_types
+        if event_types is not None and event.event not in event_types:
+            return False
+        if self.match is not None and not self.match(event):
+            return False
+        if self.tags is not None:
+            if self._tag_prefilter and not any(
+                    tag in event.data for tag in self.tags):
+                return False
+            try:
+                data = event.json()
+            except ValueError:
+                log.warning("Dropping undecodable event %r", event)
+                return False
+            if not isinstance(data, dict):
+                return False
+            tags = data.get('tags') or ()
+            if not self.tags.intersection(tags):
+                return False
+        return True
+
+
+# Put on the queue when the stream is closed
+_closed = object()
+
+
+class EventStream(object):
+    """
+    Iterate over the decoded events from an SSE URL, reconnecting as
+    needed.
+
+    After a dropped connection, the stream reconnects with the id of the
+    last event seen in the Last-Event-ID header, so the server can send what
+    was missed.  Reconnects are spaced by retry_policy.backoff(), which
+    resets once events flow again, and are never sooner than a 'retry' the
+    server asked for.
+
+    Only events passing the event_types, tags and match filters (see
+    EventFilter) are decoded and queued.
+
+    At most max_queue events wait for the consumer.  When the queue is full,
+    'overflow' decides what happens: 'block' stops reading from the server
+    until there is room, 'drop_oldest' discards the longest waiting event
+    and 'drop_newest' the arriving one.  Dropped events are counted in
+    stats().
+
+    'timeout' is passed to requests: by default DEFAULT_TIMEOUT, so that a
+    connection that has silently died is dropped and resumed.
+    """
+    overflow_policies = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, url, session=None, last_event_id=None,
+                 event_types=None, tags=None, match=None, max_queue=1000,
+                 overflow='block', retry_policy=None,
+                 timeout=DEFAULT_TIMEOUT):
+        if overflow not in self.overflow_policies:
+            raise ValueError('overflow must be one of %s' %
+                             ', '.join(self.overflow_policies))
+        self.url = url
+        self.session = session or requests.session()
+        self.last_event_id = last_event_id
+        self.accepts = EventFilter(event_types, tags, match)
+        self.overflow = overflow
+        self.retry_policy = retry_policy or rpc.RetryPolicy(base=0.5, cap=30)
+        self.timeout = timeout
+        self.server_retry = 0
+
+        self.received = 0
+        self.filtered = 0
+        self.dropped = 0
+        self.delivered = 0
+        self.reconnects = 0
+        self.started = None
+
+        self._queue = queue.Queue(max_queue)
+        self._stop = threading.Event()
+        self._response = None
+        self._thread = None
+
+    def __iter__(self):
+        for event in self.iter_events():
+            yield event.json()
+
+    def iter_events(self):
+        """
+        Iterate over the events as Event objects, undecoded unless a tags
+        filter needed to decode them.
+        """
+        self.start()
+        try:
+            while True:
+                try:
+                    event = self._queue.get(timeout=0.5)
+                except queue.Empty:
+                    # The _closed marker is lost if the queue was full.
+                    if self._stop.is_set():
+                        return
+                    continue
+                if event is _closed:
+                    return
+                self.delivered += 1
+                yield event
+        finally:
+            self.close()
+
+    def start(self):
+        """
+        Start reading events in the background.  Called by iteration.
+        """
+        if self._thread is not None:
+            return
+        self.started = time.time()
+        self._thread = threading.Thread(
+            target=self._run, name='events %s' % self.url)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        response = self._response
+        if response is not None:
+            # Unblocks the reader thread.
+            response.close()
+        try:
+            self._queue.put_nowait(_closed)
+        except queue.Full:
+            pass
+
+    def stats(self):
+        elapsed = time.time() - self.started if self.started else 0
+        return {
+            'received': self.received,
+            'filtered': self.filtered,
+            'dropped': self.dropped,
+            'delivered': self.delivered,
+            'queued': self._queue.qsize(),
+            'reconnects': self.reconnects,
+            'per_second': self.received / elapsed if elapsed else 0,
+        }
+
+    def _run(self):
+        attempt = 0
+        while not self._stop.is_set():
+            try:
+                for event in self._read():
+                    attempt = 0
+                    self._offer(event)
+            except Exception as exc:
+                if self._stop.is_set():
+                    break
+                log.warning("Event stream from %s failed: %r", self.url, exc)
+            if self._stop.is_set():
+                break
+            delay = max(self.retry_policy.backoff(attempt), self.server_retry)
+            attempt += 1
+            self.reconnects += 1
+            self._stop.wait(delay)
+
+    def _read(self):
+        headers = {'Accept': 'text/event-stream'}
+        if self.last_event_id is not None:
+            headers['Last-Event-ID'] = self.last_event_id
+        response = self.session.get(
+            self.url, headers=headers, stream=True, timeout=self.timeout)
+        self._response = response
+        try:
+            response.raise_for_status()
+            # Event streams are always UTF-8.
+            response.encoding = 'utf-8'
+            # chunk_size=None hands over data as soon as it arrives.
+            lines = response.iter_lines(chunk_size=None, decode_unicode=True)
+            for event in parse_lines(lines, self._set_retry):
+                if event.id is not None:
+                    self.last_event_id = event.id
+                yield event
+        finally:
+            self._response = None
+            response.close()
+
+    def _set_retry(self, seconds):
+        self.server_retry = seconds
+
+    def _offer(self, event):
+        self.received += 1
+        if not self.accepts(event):
+            self.filtered += 1
+            return
+        if self.overflow == 'block':
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(event, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+        elif self.overflow == 'drop_newest':
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                self.dropped += 1
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(event)
+                    return
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+
+
+def _is_ascii(text):
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+class Detached(Exception):
+    """
+    Raised from a Subscription that fell too far behind and was cut off.
+    """
+
+
+class Subscription(object):
+    """
+    One consumer of an EventHub.  Iterate over it for decoded events, or
+    over iter_events() for Event objects.  Raises Detached once it has
+    fallen behind by a full queue and been dropped by the hub.
+    """
+    def __init__(self, hub, accepts, max_queue):
+        self.hub = hub
+        self.accepts = accepts
+        self.delivered = 0
+        self.detached = False
+        self._queue = queue.Queue(max_queue)
+        self._closed = False
+
+    def __iter__(self):
+        for event in self.iter_events():
+            yield event.json()
+
+    def iter_events(self):
+        try:
+            while True:
+                try:
+                    event = self._queue.get(timeout=0.5)
+                except queue.Empty:
+                    if self.detached:
+                        raise Detached(
+                            'fell %d events behind' % self._queue.maxsize)
+                    # Closed, perhaps from another thread or by the hub,
+                    # and the _closed marker may not have fit in the queue.
+                    if self._closed:
+                        return
+                    continue
+                if event is _closed:
+                    return
+                self.delivered += 1
+                yield event
+        finally:
+            self.close()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.hub.unsubscribe(self)
+
+    def _offer(self, event):
+        """
+        Queue an event if it passes the filter.  Return False if the queue
+        is full.
+        """
+        if not self.accepts(event):
+            return True
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            return False
+        return True
+
+
+class EventHub(object):
+    """
+    Share one EventStream between any number of Subscriptions in the
+    process, each with its own filters and bounded queue.
+
+    A dispatcher thread hands each event from the stream to every
+    subscription whose filters accept it.  A subscription whose queue is
+    full is detached instead of holding up the others.
+
+    Keyword arguments are passed to the upstream EventStream (session,
+    retry_policy, timeout and so on).  The stream is opened with the first
+    subscription and closed by close().
+    """
+    def __init__(self, url, **stream_kwargs):
+        self.url = url
+        self.stream_kwargs = stream_kwargs
+        self.stream = None
+        self.detached = 0
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, event_types=None, tags=None, match=None,
+                  max_queue=100):
+        subscription = Subscription(
+            self, EventFilter(event_types, tags, match), max_queue)
+        with self._lock:
+            # Replaced rather than changed, so the dispatcher can iterate
+            # over it without the lock.
+            self._subscriptions = self._subscriptions + [subscription]
+            if self._thread is None:
+                self.stream = EventStream(self.url, **self.stream_kwargs)
+                self._thread = threading.Thread(
+                    target=self._dispatch, args=(self.stream,),
+                    name='event hub %s' % self.url)
+                self._thread.daemon = True
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions = [
+                sub for sub in self._subscriptions if sub is not subscription]
+
+    @property
+    def subscriptions(self):
+        return list(self._subscriptions)
+
+    def close(self):
+        with self._lock:
+            subscriptions, self._subscriptions = self._subscriptions, []
+            stream, self.stream = self.stream, None
+            self._thread = None
+        if stream is not None:
+            stream.close()
+        for subscription in subscriptions:
+            subscription._closed = True
+            try:
+                subscription._queue.put_nowait(_closed)
+            except queue.Full:
+                pass
+
+    def stats(self):
+        stats = self.stream.stats() if self.stream else {}
+        stats.update(
+            subscriptions=len(self._subscriptions),
+            detached=self.detached,
+        )
+        return stats
+
+    def _dispatch(self, stream):
+        for event in stream.iter_events():
+            for subscription in self._subscriptions:
+                if not subscription._offer(event):
+                    log.warning("Detaching slow subscriber from %s",
+                                self.url)
+                    subscription.detached = True
+                    self.detached += 1
+                    self.unsubscribe(subscription)
+
+
+_hubs = {}
+_hubs_lock = threading.Lock()
+
+
+def get_hub(url, **stream_kwargs):
+    """
+    Return the process's EventHub for url, creating it (with stream_kwargs)
+    if needed.
+    """
+    with _hubs_lock:
+        hub = _hubs.get(url)
+        if hub is None:
+            hub = _hubs[url] = EventHub(url, **stream_kwargs)
+        return hub
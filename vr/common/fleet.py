@@ -0,0 +1,622 @@
+"""
+Operations spanning many supervisor hosts at once.
+
+A Fleet wraps a collection of Host objects and fans calls out to all of them
+on a bounded thread pool, so that one slow or dead host can't stall a scan of
+the whole fleet.  RollingRestart restarts many procs across hosts in waves,
+and FleetIndex answers lookups over the procs of a whole fleet.
+"""
+import collections
+import logging
+import threading
+import time
+
+from concurrent import futures
+
+import six
+from six.moves import queue
+
+from vr.common.models import Host
+
+log = logging.getLogger(__name__)
+
+
+class HostTimeout(Exception):
+    """
+    Recorded in a FleetResult's errors for a host that didn't answer before
+    its deadline.
+    """
+
+
+class FleetResult(object):
+    """
+    The outcome of running a call against every host in a Fleet.
+
+    'results' maps host names to whatever the call returned for hosts that
+    answered in time.  'errors' maps host names to the exception raised (or
+    a HostTimeout) for those that did not.
+    """
+    def __init__(self, results, errors, elapsed):
+        self.results = results
+        self.errors = errors
+        self.elapsed = elapsed
+
+    @property
+    def complete(self):
+        return not self.errors
+
+    @property
+    def procs(self):
+        """
+        Flatten per-host lists of procs into one list.
+        """
+        return [
+            proc
+            for host_procs in self.results.values()
+            for proc in host_procs
+        ]
+
+    def __repr__(self):
+        return '<FleetResult %d ok, %d failed in %.2fs>' % (
+            len(self.results), len(self.errors), self.elapsed)
+
+
+class Fleet(object):
+    """
+    A collection of supervisor hosts, queried concurrently.
+
+    Should be initialized with an iterable of hostnames and/or Host objects.
+    Hostnames are turned into Host objects using any extra keyword arguments
+    (rpc_or_port, supervisor_username, redis_or_url, etc.).  A Redis URL
+    is opened once, and the client shared by all those hosts.
+
+    'max_workers' bounds the number of hosts being talked to at once.
+    'host_timeout' is the number of seconds any one host gets once its call
+    has started, and 'timeout' bounds the whole scan.  Hosts that blow either
+    deadline are reported in the result's errors as HostTimeout, and the
+    results gathered so far are returned regardless.
+    """
+    def __init__(self, hosts, max_workers=32, timeout=None, host_timeout=None,
+                 **host_kwargs):
+        if host_timeout:
+            host_kwargs.setdefault('rpc_timeout', host_timeout)
+        redis_spec = host_kwargs.get('redis_or_url')
+        if isinstance(redis_spec, six.string_types):
+            # One client (and connection pool) for all the hosts, so their
+            # cache reads can share a pipeline.
+            host_kwargs['redis_or_url'] = Host._init_redis(redis_spec)
+        self.hosts = [
+            Host(host, **host_kwargs)
+            if isinstance(host, six.string_types) else host
+            for host in hosts
+        ]
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.host_timeout = host_timeout
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def get_procs(self, check_cache=False):
+        """
+        Fetch procs from every host.  Returns a FleetResult whose results
+        are lists of Proc objects keyed by host name.
+
+        With check_cache=True, cached procs for all hosts are read in one
+        pipelined call per Redis server, and only hosts missing from the
+        cache are asked over RPC.
+        """
+        def get_procs(host):
+            return host.get_procs(raise_errors=True)
+
+        if not check_cache:
+            return self.map(get_procs)
+
+        start = time.time()
+        cached, missed = get_cached_procs(self.hosts)
+        result = self.map(get_procs, missed)
+        result.results.update(cached)
+        result.elapsed = time.time() - start
+        return result
+
+    def watch(self, min_interval=1, max_interval=30, stop=None):
+        """
+        Yield a ProcEvent for every change to procs on any host (see
+        Host.watch), until 'stop' is set or the generator is closed.
+
+        Each host is watched in its own thread, so max_workers and the
+        timeouts don't apply.
+        """
+        stop = stop or threading.Event()
+        events = queue.Queue()
+
+        def watch_host(host):
+            try:
+                for event in host.watch(min_interval, max_interval, stop):
+                    events.put(event)
+            except Exception:
+                log.exception("Stopped watching %s", host)
+
+        for host in self.hosts:
+            thread = threading.Thread(
+                target=watch_host, args=(host,), name='watch %s' % host.name)
+            thread.daemon = True
+            thread.start()
+        try:
+            while not stop.is_set():
+                try:
+                    yield events.get(timeout=1)
+                except queue.Empty:
+                    pass
+        finally:
+            stop.set()
+
+    def map(self, func, hosts=None):
+        """
+        Call func(host) for every host in the fleet (or just those in
+        'hosts'), concurrently, and return a FleetResult.
+        """
+        hosts = self.hosts if hosts is None else list(hosts)
+        start = time.time()
+        deadline = start + self.timeout if self.timeout else None
+        results = {}
+        errors = {}
+        started = {}
+
+        def run(host):
+            started[host.name] = time.time()
+            return func(host)
+
+        workers = max(1, min(self.max_workers, len(hosts)))
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            pending = {executor.submit(run, host): host for host in hosts}
+            while pending:
+                now = time.time()
+                self._expire(pending, started, errors, now, deadline)
+                if not pending:
+                    break
+                done, _ = futures.wait(
+                    pending,
+                    timeout=self._next_wakeup(pending, started, now, deadline),
+                    return_when=futures.FIRST_COMPLETED,
+                )
+                for fut in done:
+                    host = pending.pop(fut)
+                    try:
+                        results[host.name] = fut.result()
+                    except Exception as exc:
+                        log.warning("%s failed on %s: %r", func, host, exc)
+                        errors[host.name] = exc
+        finally:
+            # Don't wait on calls that blew their deadline.  Their threads
+            # will finish when the RPC socket times out.
+            executor.shutdown(wait=False)
+
+        return FleetResult(results, errors, time.time() - start)
+
+    def _expire(self, pending, started, errors, now, deadline):
+        """
+        Give up on any pending calls that are past the overall deadline or
+        their own per-host deadline.
+        """
+        for fut, host in list(pending.items()):
+            began = started.get(host.name)
+            if deadline is not None and now >= deadline:
+                msg = 'fleet deadline of %ss passed' % self.timeout
+            elif (self.host_timeout and began is not None
+                  and now - began >= self.host_timeout):
+                msg = 'no answer within %ss' % self.host_timeout
+            else:
+                continue
+            fut.cancel()
+            del pending[fut]
+            errors[host.name] = HostTimeout('%s: %s' % (host.name, msg))
+
+    def _next_wakeup(self, pending, started, now, deadline):
+        """
+        Return how long to wait for results before checking deadlines again.
+        """
+        wakeups = []
+        if deadline is not None:
+            wakeups.append(deadline - now)
+        if self.host_timeout:
+            for host in pending.values():
+                began = started.get(host.name)
+                # Hosts still queued have no deadline yet.  Poll so that
+                # they get one soon after they start running.
+                wakeups.append(
+                    began + self.host_timeout - now
+                    if began is not None else self.host_timeout
+                )
+        return max(0, min(wakeups)) if wakeups else None
+
+
+def get_cached_procs(hosts):
+    """
+    Read the Redis proc cache of many hosts, with one pipelined round trip
+    per Redis server instead of one per host.
+
+    Return a (cached, missed) pair.  'cached' maps host names to lists of
+    Proc objects.  'missed' lists the hosts with nothing cached, including
+    those without Redis and those whose Redis couldn't be read.
+    """
+    cached = {}
+    missed = []
+    by_redis = collections.OrderedDict()
+    for host in hosts:
+        if host.redis is None:
+            missed.append(host)
+            continue
+        by_redis.setdefault(_redis_server(host.redis), []).append(host)
+
+    for group in by_redis.values():
+        try:
+            with group[0].redis.pipeline(transaction=False) as pipe:
+                for host in group:
+                    pipe.hgetall(host.cache_key)
+                replies = pipe.execute()
+        except Exception:
+            log.exception("Failed to read proc cache for %d hosts", len(group))
+            missed.extend(group)
+            continue
+        for host, unparsed in zip(group, replies):
+            if unparsed:
+                cached[host.name] = host.procs_from_cache(unparsed)
+            else:
+                missed.append(host)
+
+    return cached, missed
+
+
+def _redis_server(client):
+    """
+    Return a key identifying the Redis server (and connection settings) a
+    client talks to, so that separately made clients for the same server
+    are grouped together.
+    """
+    pool = getattr(client, 'connection_pool', None)
+    kwargs = getattr(pool, 'connection_kwargs', None)
+    if kwargs is None:
+        return id(client)
+    # Newer redis clients also keep per-pool helper objects in there.
+    settings = sorted(
+        (name, value) for name, value in kwargs.items()
+        if value is None
+        or isinstance(value, six.string_types + six.integer_types + (float,)))
+    return (pool.connection_class,) + tuple(settings)
+
+
+class FleetIndex(object):
+    """
+    Procs from many hosts, indexed for constant-time lookups by the fields
+    parsed from their names, by host, and by (host, port).
+
+    Keep it current as hosts are refreshed with update_host(), or with add()
+    and remove() for single procs.  Updates and lookups are thread safe.
+    Lookups return new lists of procs, in no particular order.
+    """
+    fields = ('app_name', 'version', 'config_name', 'hash', 'proc_name')
+
+    def __init__(self, procs=()):
+        self._lock = threading.RLock()
+        # proc id -> proc
+        self._procs = {}
+        # field -> value -> set of proc ids
+        self._indexes = {field: collections.defaultdict(set)
+                         for field in self.fields + ('host',)}
+        # (host name, port) -> proc id
+        self._ports = {}
+        for proc in procs:
+            self.add(proc)
+
+    @classmethod
+    def from_fleet_result(cls, result):
+        return cls(result.procs)
+
+    def __len__(self):
+        return len(self._procs)
+
+    def __contains__(self, proc_id):
+        return proc_id in self._procs
+
+    def get(self, proc_id):
+        return self._procs.get(proc_id)
+
+    def add(self, proc):
+        """
+        Add a proc, or replace the one with the same id (for example with
+        a newer state).
+        """
+        with self._lock:
+            if proc.id in self._procs:
+                # Same host and name, so the same index entries.
+                self._procs[proc.id] = proc
+                return
+            self._procs[proc.id] = proc
+            for field, value in self._keys(proc):
+                self._indexes[field][value].add(proc.id)
+            if proc.port:
+                self._ports[proc.host.name, proc.port] = proc.id
+
+    def remove(self, proc_id):
+        """
+        Remove a proc by id, if present.
+        """
+        with self._lock:
+            proc = self._procs.pop(proc_id, None)
+            if proc is None:
+                return
+            for field, value in self._keys(proc):
+                ids = self._indexes[field][value]
+                ids.discard(proc_id)
+                if not ids:
+                    del self._indexes[field][value]
+            if self._ports.get((proc.host.name, proc.port)) == proc_id:
+                del self._ports[proc.host.name, proc.port]
+
+    def update_host(self, host_name, procs):
+        """
+        Make the index hold exactly 'procs' for the host: add new and changed
+        procs, and remove those that are gone.
+        """
+        with self._lock:
+            current = {proc.id for proc in procs}
+            for proc_id in list(self._indexes['host'].get(host_name, ())):
+                if proc_id not in current:
+                    self.remove(proc_id)
+            for proc in procs:
+                self.add(proc)
+
+    def find(self, **criteria):
+        """
+        Return the procs matching all criteria, each a field name (one of
+        'fields' or 'host') and a value.
+
+        >>> FleetIndex().find(app_name='web', hash='f96054b7')
+        []
+        """
+        with self._lock:
+            matches = None
+            for field, value in criteria.items():
+                ids = self._indexes[field].get(value, set())
+                matches = ids if matches is None else matches & ids
+                if not matches:
+                    return []
+            if matches is None:
+                return list(self._procs.values())
+            return [self._procs[proc_id] for proc_id in matches]
+
+    def by_port(self, host_name, port):
+        """
+        Return the proc holding 'port' on a host, or None.
+        """
+        with self._lock:
+            proc_id = self._ports.get((host_name, port))
+            return self._procs[proc_id] if proc_id else None
+
+    def hosts(self, **criteria):
+        """
+        Return the names of the hosts with procs matching the criteria (as
+        for find).
+        """
+        return set(proc.host.name for proc in self.find(**criteria))
+
+    def values(self, field):
+        """
+        Return the distinct values of an indexed field.
+        """
+        with self._lock:
+            return set(self._indexes[field])
+
+    def _keys(self, proc):
+        yield 'host', proc.host.name
+        for field in self.fields:
+            yield field, getattr(proc, field)
+
+
+class RestartError(Exception):
+    """
+    Recorded in a RestartResult for a proc that restarted but didn't reach
+    RUNNING.
+    """
+
+
+class Wave(object):
+    """
+    Timings for one wave of a RollingRestart.  'restart_time' is how long
+    the stop/start calls took, and 'ready_time' how long it then took for
+    the procs to reach RUNNING, both for the slowest host in the wave.
+    """
+    def __init__(self, number, proc_ids):
+        self.number = number
+        self.proc_ids = proc_ids
+        self.failures = 0
+        self.restart_time = 0
+        self.ready_time = 0
+        self.elapsed = 0
+
+    def __repr__(self):
+        return '<Wave %d: %d procs, %d failed in %.2fs>' % (
+            self.number, len(self.proc_ids), self.failures, self.elapsed)
+
+
+class RestartResult(object):
+    """
+    The outcome of a RollingRestart.
+
+    'succeeded' lists the ids of restarted procs.  'errors' maps the ids of
+    procs that failed to the exception (a supervisor Fault, RestartError,
+    or error talking to the host).  'skipped' lists procs not attempted
+    because the error budget ran out, in which case 'aborted' is True.
+    'waves' holds a Wave with timings for each wave run.
+    """
+    def __init__(self):
+        self.succeeded = []
+        self.errors = collections.OrderedDict()
+        self.skipped = []
+        self.waves = []
+        self.aborted = False
+        self.elapsed = 0
+
+    @property
+    def complete(self):
+        return not self.errors and not self.skipped
+
+    def __repr__(self):
+        return '<RestartResult %d ok, %d failed, %d skipped in %.2fs>' % (
+            len(self.succeeded), len(self.errors), len(self.skipped),
+            self.elapsed)
+
+
+class RollingRestart(object):
+    """
+    Restart procs across many hosts in waves.
+
+    Each wave takes up to 'max_in_flight' of the remaining procs, in order,
+    with no more than 'per_host' on any one host.  The procs in a wave are
+    restarted concurrently, with one multicall per host (see
+    Host.restart_procs).  With wait_running=True, the wave isn't over until
+    every proc in it is RUNNING, FATAL, or still not RUNNING after
+    'running_timeout' seconds; the latter two count as failures.
+
+    Once more than 'max_errors' procs have failed, no further waves are
+    started.
+    """
+    poll_interval = 1
+
+    def __init__(self, procs, max_in_flight=10, per_host=1, wait_running=True,
+                 running_timeout=60, max_errors=0):
+        self.procs = list(procs)
+        self.max_in_flight = max_in_flight
+        self.per_host = per_host
+        self.wait_running = wait_running
+        self.running_timeout = running_timeout
+        self.max_errors = max_errors
+
+    def waves(self, procs):
+        """
+        Split procs into waves, keeping their order as far as the limits
+        allow.
+        """
+        remaining = list(procs)
+        while remaining:
+            wave = []
+            per_host = collections.Counter()
+            rest = []
+            for proc in remaining:
+                host = proc.host.name
+                if (len(wave) < self.max_in_flight
+                        and per_host[host] < self.per_host):
+                    wave.append(proc)
+                    per_host[host] += 1
+                else:
+                    rest.append(proc)
+            yield wave
+            remaining = rest
+
+    def run(self):
+        start = time.time()
+        result = RestartResult()
+        workers = max(1, min(self.max_in_flight, len(self.procs)))
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            waves = self.waves(self.procs)
+            for number, procs in enumerate(waves):
+                if len(result.errors) > self.max_errors:
+                    log.error("Error budget of %d spent; stopping restart",
+                              self.max_errors)
+                    result.aborted = True
+                    result.skipped.extend(proc.id for proc in procs)
+                    for later in waves:
+                        result.skipped.extend(proc.id for proc in later)
+                    break
+                wave = self._run_wave(executor, number, procs, result)
+                result.waves.append(wave)
+                log.info("Finished %r", wave)
+        finally:
+            executor.shutdown(wait=True)
+        result.elapsed = time.time() - start
+        return result
+
+    def _run_wave(self, executor, number, procs, result):
+        wave = Wave(number, [proc.id for proc in procs])
+        start = time.time()
+        by_host = collections.OrderedDict()
+        for proc in procs:
+            by_host.setdefault(proc.host.name, []).append(proc)
+        jobs = {
+            executor.submit(self._restart_on_host, host_procs): host_procs
+            for host_procs in by_host.values()
+        }
+        for fut in futures.as_completed(jobs):
+            host_procs = jobs[fut]
+            try:
+                outcomes, restart_time, ready_time = fut.result()
+            except Exception as exc:
+                log.warning("Failed to restart procs on %s: %r",
+                            host_procs[0].host, exc)
+                outcomes = {proc.name: exc for proc in host_procs}
+                restart_time = ready_time = 0
+            wave.restart_time = max(wave.restart_time, restart_time)
+            wave.ready_time = max(wave.ready_time, ready_time)
+            for proc in host_procs:
+                error = outcomes[proc.name]
+                if error is None:
+                    result.succeeded.append(proc.id)
+                else:
+                    result.errors[proc.id] = error
+                    wave.failures += 1
+        wave.elapsed = time.time() - start
+        return wave
+
+    def _restart_on_host(self, procs):
+        """
+        Restart procs that all live on one host.  Return a dict of each
+        proc name to None or an exception, and the restart and ready times.
+        """
+        host = procs[0].host
+        start = time.time()
+        outcomes = host.restart_procs([proc.name for proc in procs])
+        restart_time = time.time() - start
+        if self.wait_running:
+            waiting = [name for name, error in outcomes.items() if not error]
+            outcomes.update(self._wait_running(host, waiting))
+        return outcomes, restart_time, time.time() - start - restart_time
+
+    def _wait_running(self, host, names):
+        outcomes = {}
+        waiting = set(names)
+        deadline = time.time() + self.running_timeout
+        while waiting:
+            try:
+                states = {
+                    proc.name: proc.statename
+                    for proc in host.get_procs(raise_errors=True)
+                }
+            except Exception as exc:
+                # The procs were restarted; only not coming up is a failure.
+                log.warning("Failed to check procs on %s: %r", host, exc)
+                states = None
+            for name in list(waiting) if states is not None else ():
+                state = states.get(name)
+                if state == 'RUNNING':
+                    outcomes[name] = None
+                elif state in ('FATAL', None):
+                    outcomes[name] = RestartError(
+                        '%s is %s on %s' % (name, state or 'missing', host))
+                else:
+                    continue
+                waiting.discard(name)
+            if waiting and time.time() >= deadline:
+                for name in waiting:
+                    outcomes[name] = RestartError(
+                        '%s not RUNNING on %s after %ss' %
+                        (name, host, self.running_timeout))
+                break
+            if waiting:
+                time.sleep(self.poll_interval)
+        return outcomes
@@ -9,6 +9,7 @@ import operator
 import os
 import re
 import socket
+import threading
 import time
 
 try:
@@ -16,14 +17,16 @@ try:
 except ImportError:
     import collections as abc
 
-from six.moves import urllib, xmlrpc_client, range
+from six.moves import urllib, xmlrpc_client
 
 import six
 import yaml
 import requests
-import sseclient
 import utc
 import contextlib2
+from concurrent import futures
+
+from vr.common import cache, events, paths, rpc, utils
 
 try:
     import redis
@@ -60,21 +63,12 @@ class TimeoutTransport(xmlrpc_client.Transport):
 
 def _retry(n, f, *args, **kwargs):
     '''Try to call f(*args, **kwargs) "n" times before giving up. Wait
-    2**n seconds before retries.'''
+    2**n seconds before retries.
 
-    for i in range(n):
-        try:
-            return f(*args, **kwargs)
-        except Exception as exc:
-            if i == n - 1:
-                log.error(
-                    '%s permanently failed with %r', f.__name__, exc)
-                raise
-            else:
-                log.warning(
-                    '%s attempt #%d failed with %r', f.__name__, i, exc)
-                time.sleep(2 ** i)
-    raise RuntimeError('Should never get here!')
+    Superseded by rpc.RetryPolicy, which Host now uses.'''
+    policy = rpc.RetryPolicy(attempts=n, base=1, cap=None, budget=None,
+                             jitter=False)
+    return policy.call(f, *args, **kwargs)
 
 
 class Host(object):
@@ -96,19 +90,65 @@ class Host(object):
     Call host.get_proc('name') to get a Proc object for the process named
     'name'.  Call it with check_cache=True to allow fetching proc info from the
     Redis cache.  If the host has no proc with that name, ProcError will be
-    raised.
+    raised.  Only that proc is asked for over RPC, and written back to the
+    cache, unless nothing at all is cached for the host.
+
+    Pass a cache.LocalCache as local_cache to keep recently fetched proc info
+    in memory in front of Redis.  Share one LocalCache between Host objects
+    so that it outlives them.
+
+    When the Redis cache misses, only one caller (across all processes) takes
+    a short lease on the host and refreshes it.  Others wait up to
+    cache_lock_wait seconds for its result before asking supervisor
+    themselves.
+
+    With redis_cache_delta=True, a refresh only writes the procs that changed
+    and deletes those that are gone, instead of rewriting the whole hash, and
+    publishes the names of the changed and removed procs as JSON on the
+    cache_channel.  Fields in volatile_fields, which supervisor reports
+    differently on every call, don't count as changes, so the cached copies
+    of those may lag behind.
+
+    Proc records are stored in Redis with cache_codec, a cache.JSONCodec by
+    default.  Every reader of a cache key (Hosts and AsyncHosts, in every
+    process) must be given a codec that reads the new records before any
+    writer switches codecs.
+
+    Procs are returned as instances of proc_class.  Set it to CompactProc to
+    save memory and time when handling many procs.
+
+    RPC connections made from a port number are kept alive in a pool shared
+    by all Hosts in the process (see vr.common.rpc).  Failed calls are retried
+    according to retry_policy, and hosts that keep failing are skipped until
+    circuit_breaker lets a probe through.
     """
+    connection_pool = rpc.default_pool
+    retry_policy = rpc.RetryPolicy(attempts=SUPERVISOR_RPC_N_RETRIES)
+    circuit_breaker = rpc.default_breaker
+    cache_lock_lease = SUPERVISOR_RPC_TIMEOUT_SECS
+    cache_lock_wait = 2
+    cache_lock_poll = 0.05
+    volatile_fields = frozenset(['now', 'description'])
+    proc_class = None  # Proc, set below
+
     def __init__(self, name, rpc_or_port=9001, supervisor_username=None,
                  supervisor_password=None, redis_or_url=None,
-                 redis_cache_prefix='host_procs', redis_cache_lifetime=600):
+                 redis_cache_prefix='host_procs', redis_cache_lifetime=600,
+                 rpc_timeout=SUPERVISOR_RPC_TIMEOUT_SECS, local_cache=None,
+                 redis_cache_delta=False, cache_codec=None):
         self.name = name
         self.username = supervisor_username
         self.password = supervisor_password
+        self.rpc_timeout = rpc_timeout
 
         self._init_supervisor_rpc(rpc_or_port)
         self.redis = self._init_redis(redis_or_url)
         self.cache_key = ':'.join([redis_cache_prefix, name])
         self.cache_lifetime = redis_cache_lifetime
+        self.cache_channel = self.cache_key + ':changes'
+        self.cache_delta = redis_cache_delta
+        self.cache_codec = cache_codec or cache.JSONCodec()
+        self.local_cache = local_cache
 
     def _init_supervisor_rpc(self, rpc_or_port):
         '''Initialize supervisor RPC.
@@ -124,8 +164,9 @@ class Host(object):
                 leader = 'http://'
             tmpl = leader + '{self.name}:{port}'
             url = tmpl.format(self=self, port=rpc_or_port)
-            self.rpc = xmlrpc_client.ServerProxy(
-                url, transport=TimeoutTransport())
+            transport = rpc.PooledTransport(
+                self.rpc_timeout, pool=self.connection_pool)
+            self.rpc = xmlrpc_client.ServerProxy(url, transport=transport)
         else:
             self.rpc = rpc_or_port
         self.supervisor = self.rpc.supervisor
@@ -146,60 +187,428 @@ class Host(object):
 
     def get_proc(self, name, check_cache=False):
         if check_cache:
+            procs_dict = self._get_local_procs() or {}
+            if name in procs_dict:
+                return self.proc_class(self, procs_dict[name])
             # Note that if self.redis is None and check_cache is True, an
             # AttributeError will be raised.
-            cached_json = self.redis.hget(self.cache_key, name)
+            with self.redis.pipeline() as pipe:
+                pipe.hget(self.cache_key, name)
+                pipe.exists(self.cache_key)
+                cached_json, cached_host = pipe.execute()
             if cached_json:
-                return Proc(self, json.loads(cached_json))
-            else:
-                procs_dict = self._get_and_cache_procs()
-        else:
-            procs_dict = self._get_and_cache_procs()
+                data = self.cache_codec.loads(cached_json)
+                return self.proc_class(self, data)
+            if not cached_host:
+                # Nothing cached for this host at all.  Fill the whole cache,
+                # since other procs will likely be asked for next.
+                procs_dict = self._refresh_after_miss(
+                    self._get_and_cache_procs)
+                if name in procs_dict:
+                    return self.proc_class(self, procs_dict[name])
+                raise ProcError(
+                    'host %s has no proc named %s' % (self.name, name))
+
+        return self.proc_class(self, self._get_and_cache_proc(name))
+
+    # Set one field of a hash, but only if the hash already exists.  A single
+    # proc written to an expired cache would look like a host with one proc.
+    _hset_if_exists = '''
+        if redis.call('exists', KEYS[1]) == 1 then
+            redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+            return 1
+        end
+        return 0
+    '''
+
+    def _get_and_cache_proc(self, name):
+        '''Fetch one proc's info from supervisor and update its entry in the
+        cache, if the host's procs are cached.'''
+        missing = ProcError('host %s has no proc named %s' % (self.name, name))
+        try:
+            data = self._call(self.supervisor.getProcessInfo, name)
+        except xmlrpc_client.Fault as f:
+            if f.faultString.startswith('BAD_NAME'):
+                raise missing
+            raise
+        except rpc.CircuitOpen as exc:
+            log.warning("Not connecting to %s: %s", self, exc)
+            raise missing
+        except Exception:
+            log.exception("Failed to connect to %s", self)
+            raise missing
 
-        if name in procs_dict:
-            return Proc(self, procs_dict[name])
-        else:
-            raise ProcError('host %s has no proc named %s' % (self.name, name))
+        if self.redis:
+            hset_if_exists = self.redis.register_script(self._hset_if_exists)
+            encoded = self.cache_codec.dumps(data)
+            written = hset_if_exists(
+                keys=[self.cache_key], args=[name, encoded])
+            if written and self.cache_delta:
+                notice = {'host': self.name, 'changed': [name], 'removed': []}
+                self.redis.publish(self.cache_channel, json.dumps(notice))
+        return data
 
-    def _get_and_cache_procs(self):
+    def _call(self, f, *args):
+        '''Call a supervisor RPC method with retries, unless the host is
+        known to be down.'''
+        return self.circuit_breaker.call(
+            self.name, self.retry_policy.call, f, *args)
 
+    def _get_and_cache_procs(self):
         try:
-            # Retry few times before giving up
-            proc_list = _retry(
-                SUPERVISOR_RPC_N_RETRIES, self.supervisor.getAllProcessInfo)
+            return self._fetch_and_cache_procs()
+        except rpc.CircuitOpen as exc:
+            log.warning("Not connecting to %s: %s", self, exc)
+            return {}
         except Exception:
             log.exception("Failed to connect to %s", self)
             return {}
 
+    def _fetch_and_cache_procs(self):
+        '''Like _get_and_cache_procs, but let RPC failures propagate.'''
+        proc_list = self._call(self.supervisor.getAllProcessInfo)
+
         # getAllProcessInfo returns a list of dicts.  Reshape that into a dict
         # of dicts, keyed by proc name.
         proc_dict = {d['name']: d for d in proc_list}
-        if self.redis:
+        if self.redis and self.cache_delta:
+            self._update_cache(proc_dict)
+        elif self.redis:
             # Use pipeline to do hash clear, set, and expiration in
             # same redis call
             with self.redis.pipeline() as pipe:
 
                 # First clear all existing data in the hash
                 pipe.delete(self.cache_key)
-                # Now set all the hash values, dumped to json.
-                dumped = {d: json.dumps(proc_dict[d]) for d in proc_dict}
+                # Now set all the hash values, encoded with the codec.
+                dumps = self.cache_codec.dumps
+                dumped = {d: dumps(proc_dict[d]) for d in proc_dict}
                 pipe.hmset(self.cache_key, dumped)
                 pipe.expire(self.cache_key, self.cache_lifetime)
                 pipe.execute()
+        self._set_local_procs(proc_dict)
 
         return proc_dict
 
-    def get_procs(self, check_cache=False):
+    def _update_cache(self, proc_dict):
+        '''Bring the cache hash in line with proc_dict, writing only what
+        changed, and publish a notice of the changes.'''
+        cached = self._decode_cache(self.redis.hgetall(self.cache_key))
+        changed = {
+            name: self.cache_codec.dumps(data)
+            for name, data in proc_dict.items()
+            if self._proc_changed(cached.get(name), data)
+        }
+        removed = [name for name in cached if name not in proc_dict]
+
+        with self.redis.pipeline() as pipe:
+            if changed:
+                pipe.hset(self.cache_key, mapping=changed)
+            if removed:
+                pipe.hdel(self.cache_key, *removed)
+            pipe.expire(self.cache_key, self.cache_lifetime)
+            if changed or removed:
+                notice = {
+                    'host': self.name,
+                    'changed': sorted(changed),
+                    'removed': sorted(removed),
+                }
+                pipe.publish(self.cache_channel, json.dumps(notice))
+            pipe.execute()
+
+    def _proc_changed(self, old, new):
+        if old is None:
+            return True
+        keys = set(old) | set(new)
+        return any(
+            old.get(k) != new.get(k)
+            for k in keys - self.volatile_fields
+        )
+
+    def get_procs(self, check_cache=False, raise_errors=False):
+        # By default a host that can't be reached just has no procs.  Pass
+        # raise_errors=True to have the RPC failure propagate instead.
+        if raise_errors:
+            fetch = self._fetch_and_cache_procs
+        else:
+            fetch = self._get_and_cache_procs
+
+        all_data = None
         if check_cache:
+            all_data = self._get_local_procs()
+            if all_data is None:
+                unparsed = self.redis.hgetall(self.cache_key)
+                if unparsed:
+                    return self.procs_from_cache(unparsed)
+                all_data = self._refresh_after_miss(fetch)
+        if all_data is None:
+            all_data = fetch()
+
+        return [self.proc_class(self, all_data[d]) for d in all_data]
+
+    def _refresh_after_miss(self, fetch):
+        '''Call fetch() to refresh the cache after a miss, unless someone else
+        is already doing so, in which case wait for their result.'''
+        lock = self.redis.lock(
+            self.cache_key + ':lock', timeout=self.cache_lock_lease)
+        if lock.acquire(blocking=False):
+            try:
+                return fetch()
+            finally:
+                try:
+                    lock.release()
+                except redis.exceptions.LockError:
+                    # The lease ran out before the refresh was done.
+                    pass
+
+        deadline = time.time() + self.cache_lock_wait
+        while time.time() < deadline:
+            time.sleep(self.cache_lock_poll)
             unparsed = self.redis.hgetall(self.cache_key)
             if unparsed:
-                all_data = {v: json.loads(v) for v in unparsed.values()}
+                proc_dict = self._decode_cache(unparsed)
+                self._set_local_procs(proc_dict)
+                return proc_dict
+        log.warning("Gave up waiting for another refresh of %s", self)
+        return fetch()
+
+    def procs_from_cache(self, unparsed):
+        '''Return Proc objects from the raw contents of the cache hash, as
+        returned by HGETALL.'''
+        proc_dict = self._decode_cache(unparsed)
+        self._set_local_procs(proc_dict)
+        return [self.proc_class(self, proc_dict[d]) for d in proc_dict]
+
+    def _decode_cache(self, unparsed):
+        data = map(self.cache_codec.loads, unparsed.values())
+        return {d['name']: d for d in data}
+
+    def _get_local_procs(self):
+        '''Return the dict of proc data held in the local cache, or None.  A
+        stale entry is returned too, while a background refresh replaces
+        it.'''
+        if self.local_cache is None:
+            return None
+        proc_dict, fresh = self.local_cache.lookup(self.cache_key)
+        if proc_dict is not None and not fresh:
+            self.local_cache.revalidate(self.cache_key, self._refresh_cache)
+        return proc_dict
+
+    def _set_local_procs(self, proc_dict):
+        if self.local_cache is not None:
+            self.local_cache.set(self.cache_key, proc_dict)
+
+    def _refresh_cache(self):
+        '''Reload the local cache from Redis, or from supervisor (which also
+        repopulates Redis) if Redis has nothing.'''
+        if self.redis:
+            unparsed = self.redis.hgetall(self.cache_key)
+            if unparsed:
+                self._set_local_procs(self._decode_cache(unparsed))
+                return
+        self._fetch_and_cache_procs()
+
+    def watch(self, min_interval=1, max_interval=30, stop=None):
+        """
+        Yield a ProcEvent for every change to the procs on this host, until
+        the 'stop' threading.Event (if any) is set.
+
+        Supervisor is polled every min_interval seconds, backing off towards
+        max_interval while nothing changes.  When the host publishes cache
+        change notices (redis_cache_delta=True), a notice from another
+        process's refresh is picked up right away instead, and only the
+        changed procs are read from Redis.
+
+        Each snapshot is compared with the last by proc state and pid only.
+        """
+        stop = stop or threading.Event()
+        pubsub = None
+        if self.redis and self.cache_delta:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.cache_channel)
+        try:
+            snapshot = self._watch_snapshot()
+            interval = min_interval
+            while not stop.is_set():
+                notice = self._wait_for_notice(pubsub, interval, stop)
+                if stop.is_set():
+                    return
+                if notice and snapshot is not None:
+                    current, names = self._apply_notice(snapshot, notice)
+                else:
+                    current = self._watch_snapshot()
+                    if snapshot is None or current is None:
+                        # Nothing to compare yet, or couldn't reach the
+                        # host; try again later.
+                        snapshot = snapshot or current
+                        continue
+                    names = set(snapshot) | set(current)
+                changed = False
+                for event in self._diff_procs(snapshot, current, names):
+                    changed = True
+                    yield event
+                snapshot = current
+                if changed or notice:
+                    interval = min_interval
+                else:
+                    interval = min(interval * 2, max_interval)
+        finally:
+            if pubsub is not None:
+                pubsub.close()
+
+    def _watch_snapshot(self):
+        try:
+            return self._fetch_and_cache_procs()
+        except Exception as exc:
+            log.warning("Failed to poll %s: %r", self, exc)
+            return None
+
+    @staticmethod
+    def _wait_for_notice(pubsub, timeout, stop):
+        if pubsub is None:
+            stop.wait(timeout)
+            return None
+        deadline = time.time() + timeout
+        while not stop.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            # Wake up at least once a second to check 'stop'.
+            message = pubsub.get_message(timeout=min(remaining, 1))
+            if message and message['type'] == 'message':
+                return json.loads(message['data'])
+
+    def _apply_notice(self, snapshot, notice):
+        """
+        Return a copy of snapshot updated with the procs named in a cache
+        change notice, read from Redis, and the names involved.
+        """
+        current = dict(snapshot)
+        changed = notice['changed']
+        if changed:
+            raw = self.redis.hmget(self.cache_key, changed)
+            for name, encoded in zip(changed, raw):
+                if encoded is not None:
+                    current[name] = self.cache_codec.loads(encoded)
+        for name in notice['removed']:
+            current.pop(name, None)
+        return current, set(changed) | set(notice['removed'])
+
+    def _diff_procs(self, old, new, names):
+        for name in names:
+            before = old.get(name)
+            after = new.get(name)
+            if after is None:
+                if before is not None:
+                    yield ProcEvent('removed', self, name, None, before)
+                continue
+            if before is None:
+                kind = 'appeared'
+            elif (before['state'] == after['state']
+                  and before['pid'] == after['pid']):
+                continue
             else:
-                all_data = self._get_and_cache_procs()
-        else:
-            all_data = self._get_and_cache_procs()
+                kind = ProcEvent.kinds.get(after['statename'], 'changed')
+            yield ProcEvent(kind, self, name, self.proc_class(self, after),
+                            before)
+
+    def start_procs(self, names):
+        """
+        Start the named procs, in a single system.multicall.
+
+        Return a dict of each name to None if it started (or was already
+        running), or to the xmlrpc_client.Fault supervisor gave for it.
+        Errors talking to supervisor at all are raised.
+        """
+        return self._multicall('startProcess', names, 'ALREADY_STARTED')
 
-        return [Proc(self, all_data[d]) for d in all_data]
+    def stop_procs(self, names):
+        """
+        Stop the named procs, in a single system.multicall.  Returns results
+        like start_procs; a proc that wasn't running counts as stopped.
+        """
+        return self._multicall('stopProcess', names, 'NOT_RUNNING')
+
+    def restart_procs(self, names):
+        """
+        Stop the named procs, then start the ones that stopped, in two
+        multicalls.  Returns results like start_procs.
+        """
+        names = list(names)
+        results = self.stop_procs(names)
+        stopped = [name for name in names if results[name] is None]
+        results.update(self.start_procs(stopped))
+        return results
+
+    def get_settings(self, names=None):
+        """
+        Return a dict of proc names to ProcData (or None for procs without
+        settings), for the named procs or by default all procs on the host.
+        Settings not already cached are fetched in a single multicall.
+        """
+        if names is None:
+            names = [proc.name for proc in self.get_procs(raise_errors=True)]
+        results = {}
+        missing = []
+        for name in names:
+            settings = self.proc_class.cached_settings(self.name, name)
+            if settings is None:
+                missing.append(name)
+            else:
+                results[name] = settings
+        if not missing:
+            return results
+
+        calls = [
+            {'methodName': 'vr.get_velociraptor_info', 'params': [name]}
+            for name in missing
+        ]
+        responses = self._call(self.rpc.system.multicall, calls)
+        for name, response in zip(missing, responses):
+            fault = self._multicall_fault(response)
+            if fault is not None:
+                log.warning("Failed to get settings for %s: %s", name,
+                            fault.faultString)
+                results[name] = None
+                continue
+            results[name] = self.proc_class.cache_settings(
+                self.name, name, response)
+        return results
+
+    @staticmethod
+    def _multicall_fault(response):
+        """
+        Return a Fault for one call's response in a system.multicall, or
+        None if it succeeded.  Supervisor returns the values of successful
+        calls as they are, and a fault struct for failed ones.
+        """
+        if isinstance(response, dict) and 'faultCode' in response:
+            return xmlrpc_client.Fault(
+                response['faultCode'], response['faultString'])
+
+    def _multicall(self, method, names, tolerated):
+        names = list(names)
+        if not names:
+            return {}
+        calls = [
+            {'methodName': 'supervisor.' + method, 'params': [name]}
+            for name in names
+        ]
+        responses = self._call(self.rpc.system.multicall, calls)
+        results = {}
+        for name, response in zip(names, responses):
+            fault = self._multicall_fault(response)
+            if fault is not None:
+                # Supervisor puts the proc name after the code.
+                code = fault.faultString.split(':')[0]
+                if code == tolerated:
+                    log.warning("%s for process %s", code, name)
+                    fault = None
+                else:
+                    log.error("Failed to %s %s: %s", method, name,
+                              fault.faultString)
+            results[name] = fault
+        return results
 
     def shortname(self):
         return self.name.split(".")[0]
@@ -212,7 +621,199 @@ class Host(object):
         return "<%(cls)s %(name)s>" % info
 
 
-class Proc(object):
+# Upper bound on the number of proc names whose parsed form (and shortname)
+# is kept in memory.  Once reached, the cache starts over, so names from old
+# deploys don't pile up.
+NAME_CACHE_SIZE = 10000
+_parsed_names = {}
+_shortnames = {}
+
+
+def _remember(memo, key, value):
+    if len(memo) >= NAME_CACHE_SIZE:
+        memo.clear()
+    memo[key] = value
+
+
+def _parse_name(name):
+    # Returns the cached dict itself; callers must not modify it.
+    try:
+        return _parsed_names[name]
+    except KeyError:
+        pass
+    try:
+        app_name, version, config_name, rel_hash, proc_name, port = \
+            name.split('-')
+
+        parsed = {
+            'app_name': app_name,
+            'version': version,
+            'config_name': config_name,
+            'hash': rel_hash,
+            'proc_name': proc_name,
+            'port': int(port)
+        }
+    except ValueError:
+        parsed = {
+            'app_name': name,
+            'version': 'UNKNOWN',
+            'config_name': 'UNKNOWN',
+            'hash': 'UNKNOWN',
+            'proc_name': name,
+            'port': 0
+        }
+    _remember(_parsed_names, name, parsed)
+    return parsed
+
+
+class BaseProc(object):
+    """
+    Behavior shared by Proc and CompactProc.  Subclasses provide the host,
+    name and other attributes described in Proc.
+    """
+    __slots__ = ()
+
+    # The attributes included in as_dict() (plus 'host'), in order.
+    fields = (
+        'description', 'exitstatus', 'group', 'logfile', 'name', 'now', 'pid',
+        'spawnerr', 'start_time', 'state', 'statename', 'stderr_logfile',
+        'stdout_logfile', 'stop_time', 'app_name', 'version', 'config_name',
+        'hash', 'proc_name', 'port', 'jsname', 'id',
+    )
+
+    # ProcData from vr.agent, shared by all procs in the process and keyed
+    # by host and proc name.  The name includes the release hash, so an
+    # entry can't go stale while its proc exists.
+    settings_cache = cache.LocalCache(max_size=4096, ttl=3600)
+
+    @property
+    def hostname(self):
+        return self.host.name
+
+    @property
+    def settings(self):
+        settings = self.cached_settings(self.host.name, self.name)
+        if settings is None:
+            settings = self.cache_settings(
+                self.host.name, self.name,
+                self.host.rpc.vr.get_velociraptor_info(self.name))
+        return settings
+
+    @classmethod
+    def cached_settings(cls, host_name, name):
+        """
+        Return the cached ProcData for a proc, or None.
+        """
+        if _parse_name(name)['hash'] == 'UNKNOWN':
+            # Not named by Velociraptor, so the name doesn't pin a release.
+            return None
+        return cls.settings_cache.get((host_name, name))
+
+    @classmethod
+    def cache_settings(cls, host_name, name, raw):
+        """
+        Build ProcData from the result of get_velociraptor_info, cache it
+        and return it.  Return None for a proc without settings.
+        """
+        if not raw:
+            return None
+        settings = ProcData(raw)
+        if _parse_name(name)['hash'] != 'UNKNOWN':
+            cls.settings_cache.set((host_name, name), settings)
+        return settings
+
+    @staticmethod
+    def parse_name(name):
+        """
+        Split a proc name made by paths.get_container_name into its parts.
+        Results are cached, so this is cheap for names seen before.
+
+        >>> parsed = Proc.parse_name('app-v1-prod-abc123-web-5000')
+        >>> parsed['app_name'], parsed['port']
+        ('app', 5000)
+        """
+        return dict(_parse_name(name))
+
+    @staticmethod
+    def format_name(parsed):
+        """
+        The inverse of parse_name.
+
+        >>> Proc.format_name(Proc.parse_name('app-v1-prod-abc123-web-5000'))
+        'app-v1-prod-abc123-web-5000'
+        """
+        return paths.format_container_name(
+            parsed['app_name'],
+            parsed['version'],
+            parsed['config_name'],
+            parsed['hash'],
+            parsed['proc_name'],
+            parsed['port'],
+        )
+
+    @classmethod
+    def name_to_shortname(cls, name):
+        """
+        In Celery tasks you often have a proc name, and want to send events
+        including the proc's shortname, but you don't want to do a XML RPC call
+        to get a full dict of data just for that.
+        """
+        try:
+            return _shortnames[name]
+        except KeyError:
+            pass
+        shortname = '%(app_name)s-%(version)s-%(proc_name)s' % \
+            _parse_name(name)
+        _remember(_shortnames, name, shortname)
+        return shortname
+
+    def __repr__(self):
+        return "<Proc %s>" % self.name
+
+    def shortname(self):
+        return '%s-%s-%s' % (self.app_name, self.version, self.proc_name)
+
+    def as_node(self):
+        """
+        Return host:port, as needed by the balancer interface.
+        """
+        return '%s:%s' % (self.host.name, self.port)
+
+    def as_json(self):
+        return json.dumps(self.as_dict())
+
+    def start(self):
+        try:
+            self.host.supervisor.startProcess(self.name)
+        except xmlrpc_client.Fault as f:
+            if f.faultString == 'ALREADY_STARTED':
+                log.warning("Process %s already started", self.name)
+            else:
+                log.exception("Failed to start %s", self.name)
+                raise
+        except Exception:
+            log.exception("Failed to start %s", self.name)
+            raise
+
+    def stop(self):
+        try:
+            self.host.supervisor.stopProcess(self.name)
+        except xmlrpc_client.Fault as f:
+            if f.faultString == 'NOT_RUNNING':
+                log.warning("Process %s not running", self.name)
+            else:
+                log.exception("Failed to stop %s", self.name)
+                raise
+        except Exception:
+            log.exception("Failed to stop %s", self.name)
+            raise
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+
+class Proc(BaseProc):
     """
     A representation of a proc running on a host.  Must be initted with the
     hostname and a dict of data structured like the one you get back from
@@ -270,65 +871,96 @@ class Proc(object):
         self.jsname = self.name.replace('.', 'dot')
         self.id = '%s-%s' % (self.host.name, self.name)
 
-    @property
-    def hostname(self):
-        return self.host.name
+    def as_dict(self):
+        data = {}
+        for k, v in self.__dict__.items():
+            if isinstance(v, six.string_types + (int,)):
+                data[k] = v
+            elif isinstance(v, datetime):
+                data[k] = v.isoformat()
+            elif v is None:
+                data[k] = v
+        data['host'] = self.host.name
+        return data
 
-    @property
-    def settings(self):
-        settings = self.host.rpc.vr.get_velociraptor_info(self.name)
-        if not settings:
-            return None
-        return ProcData(settings)
 
-    @staticmethod
-    def parse_name(name):
+def _data_field(key):
+    return property(lambda self: self._data[key], doc=key)
+
+
+def _timestamp_field(key):
+    def get(self):
+        # When a timestamp field is inapplicable, Supevisor will put a 0 there
+        # instead of a real unix timestamp.
+        ts = self._data[key]
+        return utc.fromtimestamp(ts) if ts else None
+    return property(get, doc=key)
+
+
+def _name_field(key):
+    def get(self):
         try:
-            app_name, version, config_name, rel_hash, proc_name, port = \
-                name.split('-')
-
-            return {
-                'app_name': app_name,
-                'version': version,
-                'config_name': config_name,
-                'hash': rel_hash,
-                'proc_name': proc_name,
-                'port': int(port)
-            }
-        except ValueError:
-            return {
-                'app_name': name,
-                'version': 'UNKNOWN',
-                'config_name': 'UNKNOWN',
-                'hash': 'UNKNOWN',
-                'proc_name': name,
-                'port': 0
-            }
+            parsed = self._parsed_name
+        except AttributeError:
+            parsed = self._parsed_name = self.parse_name(self._data['name'])
+        return parsed[key]
+    return property(get, doc=key)
 
-    @classmethod
-    def name_to_shortname(cls, name):
-        """
-        In Celery tasks you often have a proc name, and want to send events
-        including the proc's shortname, but you don't want to do a XML RPC call
-        to get a full dict of data just for that.
-        """
-        return '%(app_name)s-%(version)s-%(proc_name)s' % Proc.parse_name(name)
 
-    def __repr__(self):
-        return "<Proc %s>" % self.name
+class CompactProc(BaseProc):
+    """
+    A Proc with a smaller footprint, for handling many thousands at once.
 
-    def shortname(self):
-        return '%s-%s-%s' % (self.app_name, self.version, self.proc_name)
+    Attributes are the same as Proc's, but are read from the supervisor data
+    on demand instead of copied at init: timestamps are only converted to
+    datetimes, and the name only parsed, when asked for.  Instances have
+    __slots__, so other attributes can't be set on them.
 
-    def as_node(self):
-        """
-        Return host:port, as needed by the balancer interface.
-        """
-        return '%s:%s' % (self.host.name, self.port)
+    Use it in place of Proc by setting proc_class on Host (or a subclass).
+    """
+    __slots__ = ('host', '_data', '_parsed_name')
+
+    def __init__(self, host, data):
+        self.host = host
+        self._data = data
+
+    description = _data_field('description')
+    exitstatus = _data_field('exitstatus')
+    group = _data_field('group')
+    logfile = _data_field('logfile')
+    name = _data_field('name')
+    pid = _data_field('pid')
+    spawnerr = _data_field('spawnerr')
+    state = _data_field('state')
+    statename = _data_field('statename')
+    stderr_logfile = _data_field('stderr_logfile')
+    stdout_logfile = _data_field('stdout_logfile')
+
+    now = _timestamp_field('now')
+    start_time = _timestamp_field('start')
+    stop_time = _timestamp_field('stop')
+
+    app_name = _name_field('app_name')
+    version = _name_field('version')
+    config_name = _name_field('config_name')
+    hash = _name_field('hash')
+    proc_name = _name_field('proc_name')
+    port = _name_field('port')
+
+    @property
+    def jsname(self):
+        return self.name.replace('.', 'dot')
+
+    @property
+    def id(self):
+        return '%s-%s' % (self.host.name, self.name)
 
     def as_dict(self):
+        # Same output as Proc.as_dict, which only includes attributes that
+        # are strings, ints, datetimes or None.
         data = {}
-        for k, v in self.__dict__.items():
+        for k in self.fields:
+            v = getattr(self, k)
             if isinstance(v, six.string_types + (int,)):
                 data[k] = v
             elif isinstance(v, datetime):
@@ -338,38 +970,8 @@ class Proc(object):
         data['host'] = self.host.name
         return data
 
-    def as_json(self):
-        return json.dumps(self.as_dict())
-
-    def start(self):
-        try:
-            self.host.supervisor.startProcess(self.name)
-        except xmlrpc_client.Fault as f:
-            if f.faultString == 'ALREADY_STARTED':
-                log.warning("Process %s already started", self.name)
-            else:
-                log.exception("Failed to start %s", self.name)
-                raise
-        except Exception:
-            log.exception("Failed to start %s", self.name)
-            raise
-
-    def stop(self):
-        try:
-            self.host.supervisor.stopProcess(self.name)
-        except xmlrpc_client.Fault as f:
-            if f.faultString == 'NOT_RUNNING':
-                log.warning("Process %s not running", self.name)
-            else:
-                log.exception("Failed to stop %s", self.name)
-                raise
-        except Exception:
-            log.exception("Failed to stop %s", self.name)
-            raise
 
-    def restart(self):
-        self.stop()
-        self.start()
+Host.proc_class = Proc
 
 
 class ProcError(Exception):
@@ -379,6 +981,27 @@ class ProcError(Exception):
     pass
 
 
+class ProcEvent(collections.namedtuple(
+        'ProcEvent', 'kind host name proc old_data')):
+    """
+    A change to a proc, as yielded by Host.watch().
+
+    'kind' is 'appeared' or 'removed' for procs that came or went, or for
+    a state change 'started' (now RUNNING, including a restart to a new
+    pid), 'stopped', 'fatal' or 'changed' (any other state).  'proc' is
+    the proc as it is now (None once removed) and 'old_data' the supervisor
+    data it had before (None for a new proc).
+    """
+    __slots__ = ()
+
+    kinds = {
+        'RUNNING': 'started',
+        'STOPPED': 'stopped',
+        'EXITED': 'stopped',
+        'FATAL': 'fatal',
+    }
+
+
 class ConfigData(object):
     """
     Superclass for defining objects with required and optional attributes that
@@ -503,22 +1126,95 @@ class ProcHostFilter(Filter):
     getter = operator.itemgetter('host')
 
 
+_prefetch_executor = None
+_prefetch_lock = threading.Lock()
+
+
+def _prefetch_pool():
+    """
+    The thread pool QueryResults fetch pages on, created on first use.
+    """
+    global _prefetch_executor
+    with _prefetch_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = futures.ThreadPoolExecutor(max_workers=4)
+        return _prefetch_executor
+
+
 class QueryResult(abc.Iterable):
+    """
+    Iterate over the objects from every page of an API listing.
+
+    While the objects of one page are being consumed, the next page is
+    fetched in the background, unless prefetch=False.  'limit' sets the
+    page size.  The time taken to fetch each page so far is kept in
+    page_times, in seconds.
+
+    With parallel=N, the first page's meta.total_count is used to fetch the
+    remaining pages by offset, up to N at a time, instead of following
+    meta.next one page at a time.  Objects still come out in order.  Each
+    page is retried according to retry_policy.  Objects added or removed
+    during the listing may shift between pages, so this is best for
+    collections that change slowly, like releases and builds.
+
+    A QueryResult that won't be iterated to the end should be closed (or
+    used as a context manager), to cancel the page fetches it has queued.
+    """
+    retry_policy = rpc.RetryPolicy(attempts=3, base=0.5)
 
-    def __init__(self, vr, url, params):
+    def __init__(self, vr, url, params, limit=None, prefetch=True,
+                 parallel=None):
         self.vr = vr
         self.sess = vr.session
         self.url = url
-        self.params = params
+        self.params = dict(params or {})
+        if limit:
+            self.params['limit'] = limit
+        self.prefetch = prefetch
+        self.parallel = parallel
+        self.page_times = []
         self._doc = None
         self._index = 0
+        self._next = None
+        self._pending = None
+        # With parallel: offsets still to request, pages requested in order
+        # and the pool fetching them.
+        self._offsets = None
+        self._window = None
+        self._executor = None
 
     def __iter__(self):
         return self
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Stop iterating, cancel queued page fetches and shut down the
+        parallel fetching threads.  Fetches already underway are left to
+        finish, and their pages dropped.
+        """
+        pending = list(self._window or ())
+        if self._pending is not None:
+            pending.append(self._pending)
+        for future in pending:
+            future.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._doc = {'meta': {}, 'objects': []}
+        self._index = 0
+        self._next = None
+        self._pending = None
+        self._offsets = collections.deque()
+        self._window = collections.deque()
+
     def load(self, next=None):
         url = self.url
-        params = self.params or {}
+        params = dict(self.params)
         if next:
             next_url = urllib.parse.urlparse(next)
             # See what query string args we have and update our
@@ -536,21 +1232,84 @@ class QueryResult(abc.Iterable):
         resp.raise_for_status()
         return resp.json()
 
+    def _timed_load(self, next=None):
+        start = time.time()
+        doc = self.load(next)
+        self.page_times.append(time.time() - start)
+        return doc
+
+    def _set_page(self, doc):
+        self._doc = doc
+        self._index = 0
+        self._pending = None
+        self._next = doc['meta'].get('next')
+        parallel = self.parallel and 'total_count' in doc['meta']
+        if self._next and parallel and self._window is None:
+            self._start_parallel(doc)
+        elif self._next and self.prefetch and self._window is None:
+            self._pending = _prefetch_pool().submit(
+                self._timed_load, self._next)
+
+    def _start_parallel(self, doc):
+        meta = doc['meta']
+        page_size = meta.get('limit') or len(doc['objects'])
+        start = (meta.get('offset') or 0) + len(doc['objects'])
+        self._offsets = collections.deque(
+            range(start, meta['total_count'], page_size))
+        self._page_size = page_size
+        self._window = collections.deque()
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=self.parallel)
+        self._fill_window()
+
+    def _fill_window(self):
+        while self._offsets and len(self._window) < self.parallel:
+            offset = self._offsets.popleft()
+            self._window.append(self._executor.submit(
+                self.retry_policy.call, self._load_offset, offset))
+        if not self._window:
+            self._executor.shutdown(wait=False)
+
+    def _load_offset(self, offset):
+        start = time.time()
+        params = dict(self.params, offset=offset, limit=self._page_size)
+        resp = self.sess.get(self.url, params=params)
+        resp.raise_for_status()
+        doc = resp.json()
+        self.page_times.append(time.time() - start)
+        return doc
+
+    def _next_page(self):
+        """
+        Move on to the next page.  Return False if there isn't one.
+        """
+        if self._window is not None:
+            if not self._window:
+                return False
+            doc = self._window.popleft().result()
+            self._fill_window()
+            self._set_page(doc)
+            return True
+        if self._pending is not None:
+            doc = self._pending.result()
+        elif self._next:
+            doc = self._timed_load(self._next)
+        else:
+            return False
+        self._set_page(doc)
+        return True
+
     def __next__(self):
-        if not self._doc:
-            self._doc = self.load()
+        if self._doc is None:
+            self._set_page(self._timed_load())
 
         objects = self._doc['objects']
-        meta = self._doc['meta']
-
-        if self._index >= len(objects):
+        while self._index >= len(objects):
             # We reached the end of the objects in the list. Let's see
             # if there are more.
-            if meta.get('next'):
-                self._doc = self.load(meta['next'])
-                self._index = 0
-                return next(self)
-            raise StopIteration()
+            if not self._next_page():
+                raise StopIteration()
+            objects = self._doc['objects']
 
         result = objects[self._index]
         self._index += 1
@@ -625,9 +1384,29 @@ class Velociraptor(object):
         resp.raise_for_status()
         return resp.json()
 
-    def query(self, path, query):
+    def iter_load(self, path):
+        """
+        Like load(), but yield the listing's objects one at a time as the
+        response is read, instead of decoding the whole response at once.
+        """
         url = self._build_url(path)
-        return QueryResult(self, url, params=query)
+        url += '?format=json&limit=9999'
+        resp = self.session.get(url, stream=True)
+        try:
+            resp.raise_for_status()
+            for obj in utils.stream_json_items(resp, 'objects'):
+                yield obj
+        finally:
+            resp.close()
+
+    def query(self, path, query, **kwargs):
+        """
+        Return a QueryResult for the listing at path, filtered by the query
+        params.  Keyword arguments (limit, prefetch, parallel) are passed to
+        QueryResult.
+        """
+        url = self._build_url(path)
+        return QueryResult(self, url, params=query, **kwargs)
 
     def cut(self, build, **kwargs):
         """
@@ -639,11 +1418,23 @@ class Velociraptor(object):
         joiner = urllib.parse.urljoin
         return functools.reduce(joiner, parts, self.base)
 
-    def events(self):
+    def events(self, **kwargs):
+        """
+        Iterate over the decoded events from the Velociraptor event stream.
+        Keyword arguments (filters, queue size and overflow policy, and so
+        on) are passed to events.EventStream.
+        """
+        url = self._build_url('api/streams/events/')
+        return iter(events.EventStream(url, session=self.session, **kwargs))
+
+    def subscribe(self, **kwargs):
+        """
+        Subscribe to the Velociraptor event stream through the process's
+        shared events.EventHub, instead of opening a connection of its own.
+        Keyword arguments are passed to EventHub.subscribe.
+        """
         url = self._build_url('api/streams/events/')
-        messages = sseclient.SSEClient(url, auth=self.session.auth)
-        for msg in messages:
-            yield json.loads(msg.data)
+        return events.get_hub(url, session=self.session).subscribe(**kwargs)
 
 
 class BaseResource(object):
@@ -686,11 +1477,12 @@ class BaseResource(object):
         return resp
 
     @classmethod
-    def load_all(cls, vr, params=None):
+    def load_all(cls, vr, params=None, parallel=None):
         """
-        Create instances of all objects found
+        Create instances of all objects found.  Pass parallel=N to fetch up
+        to N pages at once (see QueryResult).
         """
-        ob_docs = vr.query(cls.base, params)
+        ob_docs = vr.query(cls.base, params, parallel=parallel)
         return [cls(vr, ob) for ob in ob_docs]
 
     @classmethod
@@ -21,13 +21,29 @@ def get_lxc_work_path(settings):
 
 
 def get_container_name(settings):
-    return '-'.join([
+    return format_container_name(
         settings.app_name,
         settings.version,
         settings.config_name,
         settings.release_hash,
         settings.proc_name,
-        str(settings.port),
+        settings.port,
+    )
+
+
+def format_container_name(app_name, version, config_name, release_hash,
+                          proc_name, port):
+    """
+    Join the parts of a container (and supervisor proc) name.  The inverse of
+    vr.common.models.Proc.parse_name.
+    """
+    return '-'.join([
+        app_name,
+        version,
+        config_name,
+        release_hash,
+        proc_name,
+        str(port),
     ])
 
 
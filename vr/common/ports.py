@@ -0,0 +1,205 @@
+"""
+Choosing free ports for new procs, from the ports that hosts' procs already
+use.
+"""
+import collections
+import heapq
+import socket
+import threading
+import time
+
+
+class NoFreePorts(Exception):
+    """
+    Raised when no candidate host has a free port in the allocator's range.
+    """
+
+
+class PortAllocator(object):
+    """
+    Track the ports in use on many hosts, and hand out free ones.
+
+    Used ports for each host are kept as a bitmap over the range
+    [low, high).  Hosts are kept in a heap by number of free ports, so
+    reserve() can pick the least used host in O(log n) and its lowest free
+    port with a few integer operations.
+
+    A reserved port counts as used until it is released, seen in the host's
+    procs via update_host(), or 'reservation_ttl' seconds pass.  Given a
+    Redis client, reservations are also made there with SET NX, so that
+    allocators in other processes (sharing the same Redis) don't hand out
+    the same port before it shows up in the host's procs.
+
+    >>> allocator = PortAllocator(low=5000, high=5010)
+    >>> allocator.update_host('host1', [5000, 5001, 5003])
+    >>> allocator.reserve()
+    ('host1', 5002)
+    """
+    def __init__(self, low=5000, high=9000, redis=None, reservation_ttl=300,
+                 redis_prefix='port_reservations'):
+        self.low = low
+        self.high = high
+        self.redis = redis
+        self.reservation_ttl = reservation_ttl
+        self.redis_prefix = redis_prefix
+        # Identifies this allocator's reservations in Redis
+        self.owner = '%s:%d:%d' % (socket.gethostname(), id(self), time.time())
+        self._lock = threading.Lock()
+        # host name -> int with bit (port - low) set for each used port
+        self._used = {}
+        # host name -> number of free ports
+        self._free = {}
+        # host name -> {port: reservation expiry}
+        self._reserved = collections.defaultdict(dict)
+        # Earliest reservation expiry, or None with no reservations
+        self._next_expiry = None
+        # (-free ports, host name) entries.  Entries for hosts whose count
+        # has since changed are skipped when popped.
+        self._heap = []
+
+    @classmethod
+    def from_procs(cls, procs, **kwargs):
+        """
+        Build an allocator from procs on any number of hosts, such as
+        FleetResult.procs.
+        """
+        allocator = cls(**kwargs)
+        by_host = collections.defaultdict(list)
+        for proc in procs:
+            by_host[proc.host.name].append(proc.port)
+        for host_name, ports in by_host.items():
+            allocator.update_host(host_name, ports)
+        return allocator
+
+    def update_host(self, host_name, ports):
+        """
+        Set the ports in use on a host, as found in its procs (Proc.port).
+        Unexpired reservations for the host stay in effect.
+        """
+        with self._lock:
+            ports = set(ports)
+            now = time.time()
+            reserved = self._reserved[host_name]
+            for port, expires in list(reserved.items()):
+                if port in ports or expires <= now:
+                    del reserved[port]
+            used = 0
+            for port in ports | set(reserved):
+                if self.low <= port < self.high:
+                    used |= 1 << (port - self.low)
+            self._set_used(host_name, used)
+
+    def is_free(self, host_name, port):
+        with self._lock:
+            self._expire_reservations()
+        used = self._used.get(host_name, 0)
+        return (self.low <= port < self.high
+                and not used & (1 << (port - self.low)))
+
+    def free_count(self, host_name):
+        with self._lock:
+            self._expire_reservations()
+        return self._free.get(host_name, self.high - self.low)
+
+    def reserve(self, host_name=None):
+        """
+        Reserve a free port and return a (host name, port) pair.  With
+        host_name, the port is on that host; otherwise it's on the known
+        host with the most free ports.  Raise NoFreePorts if there are none.
+        """
+        with self._lock:
+            self._expire_reservations()
+            while True:
+                name = host_name or self._least_used()
+                port = self._lowest_free(name)
+                if port is None:
+                    if host_name:
+                        raise NoFreePorts(
+                            'no free ports on %s between %d and %d' %
+                            (host_name, self.low, self.high))
+                    continue
+                self._mark(name, port, True)
+                expires = time.time() + self.reservation_ttl
+                self._reserved[name][port] = expires
+                if self._next_expiry is None or expires < self._next_expiry:
+                    self._next_expiry = expires
+                if self._reserve_in_redis(name, port):
+                    return name, port
+                # Someone else has it; it stays marked used here.
+
+    def release(self, host_name, port):
+        """
+        Give up a reservation, e.g. after a failed deploy.
+        """
+        with self._lock:
+            if self._reserved[host_name].pop(port, None) is None:
+                return
+            self._mark(host_name, port, False)
+            if self.redis is not None:
+                key = self._redis_key(host_name, port)
+                owner = self.redis.get(key)
+                if owner in (self.owner, self.owner.encode('utf-8')):
+                    self.redis.delete(key)
+
+    def _expire_reservations(self):
+        """
+        Free the ports of expired reservations.  Must be called with the lock
+        held.
+        """
+        now = time.time()
+        if self._next_expiry is None or now < self._next_expiry:
+            return
+        self._next_expiry = None
+        for host_name, reserved in self._reserved.items():
+            for port, expires in list(reserved.items()):
+                if expires <= now:
+                    # Not seen in the host's procs, or update_host() would
+                    # have dropped the reservation.
+                    del reserved[port]
+                    self._mark(host_name, port, False)
+                elif self._next_expiry is None or expires < self._next_expiry:
+                    self._next_expiry = expires
+
+    def _least_used(self):
+        # Must be called with the lock held.
+        while self._heap:
+            free, name = self._heap[0]
+            if -free == self._free.get(name) and free:
+                return name
+            heapq.heappop(self._heap)
+        raise NoFreePorts('no free ports between %d and %d on any host' %
+                          (self.low, self.high))
+
+    def _lowest_free(self, host_name):
+        used = self._used.get(host_name, 0)
+        # (used + 1) & ~used isolates the lowest clear bit.
+        offset = ((used + 1) & ~used).bit_length() - 1
+        if offset >= self.high - self.low:
+            return None
+        return self.low + offset
+
+    def _mark(self, host_name, port, used):
+        bit = 1 << (port - self.low)
+        current = self._used.get(host_name, 0)
+        self._set_used(host_name, current | bit if used else current & ~bit)
+
+    def _set_used(self, host_name, used):
+        self._used[host_name] = used
+        free = self.high - self.low - bin(used).count('1')
+        if free != self._free.get(host_name):
+            self._free[host_name] = free
+            heapq.heappush(self._heap, (-free, host_name))
+        if len(self._heap) > 2 * len(self._free) + 16:
+            # Drop the outdated entries.
+            self._heap = [(-f, name) for name, f in self._free.items()]
+            heapq.heapify(self._heap)
+
+    def _redis_key(self, host_name, port):
+        return '%s:%s:%d' % (self.redis_prefix, host_name, port)
+
+    def _reserve_in_redis(self, host_name, port):
+        if self.redis is None:
+            return True
+        return bool(self.redis.set(
+            self._redis_key(host_name, port), self.owner,
+            nx=True, ex=self.reservation_ttl))
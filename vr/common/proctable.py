@@ -0,0 +1,247 @@
+"""
+Column-oriented storage for large snapshots of procs.
+"""
+import array
+import collections
+import numbers
+
+import six
+
+try:
+    import numpy
+except ImportError:
+    # optional dependency; plain arrays and loops are used without it
+    numpy = None
+
+
+class ProcTable(object):
+    """
+    A snapshot of many procs, across any number of hosts, stored by column
+    for cheap filtering and aggregation.
+
+    Text columns (host, statename, app_name, etc.) are dictionary-encoded:
+    each distinct value is stored once, and the column holds integer codes.
+    Numeric columns hold plain integers.  Columns are NumPy arrays when NumPy
+    is installed, and filters on them are vectorized.
+
+    Iterating over a table yields Proc objects (of each host's proc_class),
+    built from the supervisor data only as they are asked for.
+
+    >>> table = ProcTable.from_procs([])
+    >>> len(table)
+    0
+    """
+    categorical = (
+        'host', 'statename', 'app_name', 'version', 'config_name', 'hash',
+        'proc_name', 'group',
+    )
+    numeric = ('port', 'pid', 'state', 'exitstatus', 'start', 'stop', 'now')
+
+    def __init__(self, hosts, data, codes, categories, numbers):
+        # Host objects by name, for materializing procs
+        self._hosts = hosts
+        # Supervisor data dict for each row
+        self._data = data
+        # categorical column name -> array of codes
+        self._codes = codes
+        # categorical column name -> list of distinct values, by code
+        self._categories = categories
+        # numeric column name -> array of values
+        self._numbers = numbers
+
+    @classmethod
+    def from_procs(cls, procs):
+        """
+        Build a table from an iterable of Proc (or CompactProc) objects.
+        """
+        hosts = {}
+        data = []
+        categories = {name: [] for name in cls.categorical}
+        lookups = {name: {} for name in cls.categorical}
+        codes = {name: [] for name in cls.categorical}
+        numbers = {name: [] for name in cls.numeric}
+
+        def encode(column, value):
+            lookup = lookups[column]
+            code = lookup.get(value)
+            if code is None:
+                code = lookup[value] = len(categories[column])
+                categories[column].append(value)
+            codes[column].append(code)
+
+        for proc in procs:
+            hosts[proc.host.name] = proc.host
+            data.append(proc._data)
+            encode('host', proc.host.name)
+            for column in cls.categorical[1:]:
+                encode(column, getattr(proc, column))
+            numbers['port'].append(proc.port)
+            for column in ('pid', 'state', 'exitstatus', 'start', 'stop',
+                           'now'):
+                numbers[column].append(proc._data[column] or 0)
+
+        return cls(
+            hosts,
+            data,
+            {name: _int_array(values) for name, values in codes.items()},
+            categories,
+            {name: _int_array(values) for name, values in numbers.items()},
+        )
+
+    @classmethod
+    def from_fleet_result(cls, result):
+        """
+        Build a table from the FleetResult of Fleet.get_procs().
+        """
+        return cls.from_procs(result.procs)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        codes = self._codes['host']
+        names = self._categories['host']
+        for code, data in zip(codes, self._data):
+            host = self._hosts[names[code]]
+            yield host.proc_class(host, data)
+
+    def column(self, name):
+        """
+        Return the values of a column: a list for text columns, an array for
+        numeric ones.
+        """
+        if name in self._numbers:
+            return self._numbers[name]
+        categories = self._categories[name]
+        return [categories[code] for code in self._codes[name]]
+
+    def values(self, name):
+        """
+        Return the distinct values in a text column.
+        """
+        present = set(self._codes[name])
+        categories = self._categories[name]
+        return [categories[code] for code in sorted(present)]
+
+    def where(self, **criteria):
+        """
+        Return a new table with only the rows matching all criteria.
+
+        Each keyword names a column.  Its value may be a single value, a
+        set/list/tuple of acceptable values, or (for numeric columns) a
+        function taking the column array and returning a boolean mask, e.g.
+        ``where(port=lambda ports: ports >= 8000)`` with NumPy.
+        """
+        mask = None
+        for name, wanted in criteria.items():
+            column_mask = self._mask(name, wanted)
+            mask = column_mask if mask is None else _and(mask, column_mask)
+        if mask is None:
+            return self
+        return self._take(_nonzero(mask))
+
+    def count_by(self, *columns):
+        """
+        Count rows for each combination of values in the given columns.
+        Return a dict keyed by value (for one column) or by tuple of values.
+
+        >>> ProcTable.from_procs([]).count_by('app_name', 'statename')
+        {}
+        """
+        if not columns:
+            raise TypeError('count_by needs at least one column')
+        if numpy is not None and all(c in self._codes for c in columns):
+            return self._count_codes(columns)
+        # tolist() gives Python ints, with or without NumPy.
+        keys = [
+            self.column(name).tolist() if name in self._numbers
+            else self.column(name)
+            for name in columns
+        ]
+        if len(columns) == 1:
+            return dict(collections.Counter(keys[0]))
+        return dict(collections.Counter(zip(*keys)))
+
+    def _count_codes(self, columns):
+        # Combine the columns' codes into one group number per row, a column
+        # at a time, renumbering the groups that occur after each so that
+        # they stay below the number of rows.  Then count the groups, and
+        # decode each from its first row.
+        groups = numpy.zeros(len(self), dtype=numpy.int64)
+        for name in columns:
+            size = len(self._categories[name])
+            groups = groups * size + self._codes[name]
+            _, groups = numpy.unique(groups, return_inverse=True)
+        _, first_rows, counts = numpy.unique(
+            groups, return_index=True, return_counts=True)
+        result = {}
+        for row, count in zip(first_rows.tolist(), counts.tolist()):
+            values = tuple(
+                self._categories[name][self._codes[name][row]]
+                for name in columns)
+            group = values[0] if len(values) == 1 else values
+            result[group] = count
+        return result
+
+    def _mask(self, name, wanted):
+        if name in self._numbers:
+            column = self._numbers[name]
+            if callable(wanted):
+                return wanted(column)
+            return _isin(column, _as_set(wanted))
+        lookup = self._categories[name]
+        wanted = _as_set(wanted)
+        wanted_codes = set(
+            code for code, value in enumerate(lookup) if value in wanted)
+        return _isin(self._codes[name], wanted_codes)
+
+    def _take(self, indices):
+        return type(self)(
+            self._hosts,
+            [self._data[i] for i in indices],
+            {
+                name: _take(codes, indices)
+                for name, codes in self._codes.items()
+            },
+            self._categories,
+            {
+                name: _take(values, indices)
+                for name, values in self._numbers.items()
+            },
+        )
+
+
+def _as_set(wanted):
+    if isinstance(wanted, (six.string_types, numbers.Number)):
+        return set([wanted])
+    return set(wanted)
+
+
+def _int_array(values):
+    if numpy is not None:
+        return numpy.array(values, dtype=numpy.int64)
+    return array.array('l', values)
+
+
+def _isin(column, wanted):
+    if numpy is not None:
+        return numpy.isin(column, list(wanted))
+    return [value in wanted for value in column]
+
+
+def _and(left, right):
+    if numpy is not None:
+        return numpy.logical_and(left, right)
+    return [a and b for a, b in zip(left, right)]
+
+
+def _nonzero(mask):
+    if numpy is not None:
+        return numpy.flatnonzero(mask)
+    return [i for i, selected in enumerate(mask) if selected]
+
+
+def _take(column, indices):
+    if numpy is not None:
+        return column[indices]
+    return array.array(column.typecode, (column[i] for i in indices))
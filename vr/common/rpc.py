@@ -0,0 +1,390 @@
+"""
+Plumbing for talking XML-RPC to Supervisor.
+
+PooledTransport keeps HTTP connections to each supervisor alive between
+calls, in a ConnectionPool shared by every Host in the process, so that
+short-lived Host objects don't pay for a fresh TCP connect on every call.
+
+RetryPolicy and CircuitBreaker decide how hard to try a failing supervisor,
+and when to stop trying one that is known to be down.
+"""
+import collections
+import errno
+import hashlib
+import logging
+import random
+import socket
+import threading
+import time
+
+from six.moves import http_client, xmlrpc_client
+
+log = logging.getLogger(__name__)
+
+
+class PoolExhausted(Exception):
+    """
+    Raised when no connection to a host became free in time.
+    """
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of keep-alive connections, keyed by anything hashable
+    (PooledTransport uses a PoolKey).  Keys appear in error messages, so
+    shouldn't contain secrets.
+
+    At most 'max_size' connections are open per key, counting both idle and
+    checked-out ones.  Connections idle for longer than 'idle_timeout'
+    seconds are closed.
+    """
+    def __init__(self, max_size=4, idle_timeout=60):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        # key -> list of (connection, time last checked in), most recently
+        # used last.
+        self._idle = collections.defaultdict(list)
+        # key -> number of open connections, idle or checked out
+        self._open = collections.defaultdict(int)
+        self._last_sweep = time.time()
+
+    def checkout(self, key, factory, timeout=None):
+        """
+        Return a (connection, reused) pair for key, creating a connection
+        with factory() if there's no idle one and the key is under its
+        limit.  Otherwise wait up to 'timeout' seconds for one to be
+        checked in.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while True:
+                self._sweep()
+                idle = self._idle[key]
+                if idle:
+                    conn, _ = idle.pop()
+                    return conn, True
+                if self._open[key] < self.max_size:
+                    self._open[key] += 1
+                    break
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    raise PoolExhausted(
+                        'all %d connections to %s are busy' %
+                        (self.max_size, key))
+                self._cond.wait(remaining)
+
+        try:
+            return factory(), False
+        except Exception:
+            self._forget(key)
+            raise
+
+    def checkin(self, key, conn, reusable=True):
+        """
+        Return a connection to the pool.  Pass reusable=False for one that
+        failed mid-request; it will be closed instead.
+        """
+        if not reusable:
+            conn.close()
+            self._forget(key)
+            return
+        with self._cond:
+            self._idle[key].append((conn, time.time()))
+            self._cond.notify()
+
+    def _forget(self, key):
+        with self._cond:
+            self._open[key] -= 1
+            self._cond.notify()
+
+    def _sweep(self):
+        """
+        Close idle connections past their idle_timeout.  Must be called with
+        the lock held.
+        """
+        now = time.time()
+        if now - self._last_sweep < self.idle_timeout / 2.0:
+            return
+        self._last_sweep = now
+        cutoff = now - self.idle_timeout
+        for key, idle in list(self._idle.items()):
+            stale = [conn for conn, last_used in idle if last_used < cutoff]
+            if not stale:
+                continue
+            idle[:] = [item for item in idle if item[1] >= cutoff]
+            self._open[key] -= len(stale)
+            for conn in stale:
+                conn.close()
+
+    def clear(self):
+        """
+        Close all idle connections.
+        """
+        with self._cond:
+            for key, idle in self._idle.items():
+                self._open[key] -= len(idle)
+                for conn, _ in idle:
+                    conn.close()
+            self._idle.clear()
+            self._cond.notify_all()
+
+
+default_pool = ConnectionPool()
+
+
+class PoolKey(collections.namedtuple('PoolKey', 'address credentials')):
+    """
+    Pool key for an XML-RPC 'user:password@host:port' netloc: the
+    'host:port', and a digest of the credentials, so connections made with
+    different credentials aren't shared.  Shows as just the 'host:port'.
+
+    >>> key = PoolKey.from_netloc('admin:s3cret@example.com:9001')
+    >>> print(key)
+    example.com:9001
+    >>> key == PoolKey.from_netloc('admin:other@example.com:9001')
+    False
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_netloc(cls, netloc):
+        credentials, _, address = netloc.rpartition('@')
+        digest = None
+        if credentials:
+            digest = hashlib.sha1(credentials.encode('utf-8')).hexdigest()
+        return cls(address, digest)
+
+    def __str__(self):
+        return self.address
+
+
+class PooledTransport(xmlrpc_client.Transport):
+    """
+    An XML-RPC transport that checks a keep-alive connection out of a
+    ConnectionPool for each request.  Unlike the stdlib Transport, a single
+    instance is safe to use from several threads.
+    """
+    # Errors that may mean a pooled connection was closed by the other end
+    # while idle; see _is_stale().
+    _stale_errors = (socket.error, http_client.BadStatusLine)
+    _stale_errnos = frozenset([
+        errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE])
+
+    def __init__(self, timeout, pool=None, *args, **kwargs):
+        xmlrpc_client.Transport.__init__(self, *args, **kwargs)
+        self.timeout = timeout
+        self.pool = pool or default_pool
+        self._local = threading.local()
+
+    def request(self, host, handler, request_body, verbose=False):
+        def connect():
+            chost = self.get_host_info(host)[0]
+            return http_client.HTTPConnection(chost, timeout=self.timeout)
+
+        key = PoolKey.from_netloc(host)
+        for attempt in (0, 1):
+            conn, reused = self.pool.checkout(key, connect, self.timeout)
+            self._local.connection = conn
+            reusable = False
+            try:
+                result = self.single_request(
+                    host, handler, request_body, verbose)
+                reusable = True
+                return result
+            except xmlrpc_client.Fault:
+                # A fault is a complete response; the connection is fine.
+                reusable = True
+                raise
+            except self._stale_errors as exc:
+                if attempt or not reused or not self._is_stale(exc):
+                    raise
+                log.debug('Pooled connection to %s went stale', key)
+            finally:
+                self._local.connection = None
+                self.pool.checkin(key, conn, reusable)
+
+    @classmethod
+    def _is_stale(cls, exc):
+        """
+        Return whether exc means the server closed the connection before
+        reading the request, so it's safe to send again.  Like the stdlib
+        Transport, a timeout is never resent: the server may still be
+        carrying out a call like startProcess.
+        """
+        if isinstance(exc, http_client.BadStatusLine):
+            # Including RemoteDisconnected
+            return True
+        if isinstance(exc, socket.timeout):
+            return False
+        return getattr(exc, 'errno', None) in cls._stale_errnos
+
+    def make_connection(self, host):
+        # Called from single_request with the connection checked out for this
+        # thread.  get_host_info supplies the auth headers.
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        return self._local.connection
+
+    def close(self):
+        # Connections belong to the pool, which closes them when needed.
+        pass
+
+
+class RetryPolicy(object):
+    """
+    Retry a failing call up to 'attempts' times, sleeping with jittered
+    exponential backoff between attempts: a random delay of up to
+    base * 2**attempt seconds, capped at 'cap'.  No retry is started that
+    would take the total time past 'budget' seconds.
+
+    Exceptions in 'fatal' are never retried.  By default that is supervisor
+    Faults, which are answers rather than failures to answer.
+    """
+    fatal = (xmlrpc_client.Fault,)
+
+    def __init__(self, attempts=2, base=0.1, cap=2.0, budget=5.0,
+                 jitter=True):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.budget = budget
+        self.jitter = jitter
+
+    def backoff(self, attempt):
+        """
+        Return the number of seconds to sleep after failed attempt number
+        'attempt' (counting from 0).
+        """
+        delay = self.base * 2 ** attempt
+        if self.cap is not None:
+            delay = min(delay, self.cap)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def delays(self, start=None):
+        """
+        Yield the delay before each retry, stopping when attempts or the time
+        budget run out.  The budget counts from 'start', which should be the
+        time of the first attempt, and defaults to the first next().
+        """
+        if start is None:
+            start = time.time()
+        for attempt in range(self.attempts - 1):
+            delay = self.backoff(attempt)
+            if self.budget is not None:
+                remaining = self.budget - (time.time() - start)
+                if delay >= remaining:
+                    return
+            yield delay
+
+    def call(self, f, *args, **kwargs):
+        '''Call f(*args, **kwargs), retrying on any exception as the policy
+        allows.  The last exception is raised if every attempt fails.'''
+        name = getattr(f, '__name__', f)
+        delays = self.delays(time.time())
+        attempt = 0
+        while True:
+            try:
+                return f(*args, **kwargs)
+            except self.fatal:
+                raise
+            except Exception as exc:
+                delay = next(delays, None)
+                if delay is None:
+                    log.error('%s permanently failed with %r', name, exc)
+                    raise
+                log.warning(
+                    '%s attempt #%d failed with %r', name, attempt, exc)
+                time.sleep(delay)
+                attempt += 1
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling a host that recently failed repeatedly.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Track connection failures per key (Host uses the host name) and fail fast
+    for keys that are known to be down.
+
+    After 'threshold' consecutive failures a key's circuit opens, and calls
+    raise CircuitOpen without being attempted.  Once 'reset_timeout' seconds
+    have passed, a single call is let through as a probe: if it succeeds the
+    circuit closes again; if it fails the circuit stays open for another
+    reset_timeout.
+
+    Only errors in 'trip_on' count as failures.  By default that is network
+    and HTTP errors, so application errors like a supervisor Fault for an
+    unknown proc don't open the circuit.
+    """
+    trip_on = (
+        socket.error,
+        http_client.HTTPException,
+        xmlrpc_client.ProtocolError,
+        PoolExhausted,
+    )
+
+    def __init__(self, threshold=3, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        # key -> consecutive failures
+        self._failures = collections.defaultdict(int)
+        # key -> time the circuit opened, for open circuits
+        self._opened = {}
+        # keys with a half-open probe in flight
+        self._probing = set()
+
+    def is_open(self, key):
+        return key in self._opened
+
+    def allow(self, key):
+        """
+        Raise CircuitOpen unless a call for key may go ahead.
+        """
+        with self._lock:
+            opened = self._opened.get(key)
+            if opened is None:
+                return
+            retry_at = opened + self.reset_timeout
+            if time.time() < retry_at or key in self._probing:
+                raise CircuitOpen(
+                    'circuit for %s is open after %d failures' %
+                    (key, self._failures[key]))
+            self._probing.add(key)
+
+    def record_success(self, key):
+        with self._lock:
+            self._probing.discard(key)
+            self._opened.pop(key, None)
+            self._failures.pop(key, None)
+
+    def record_failure(self, key, exc):
+        if not isinstance(exc, self.trip_on):
+            # The host answered; it's not down.
+            self.record_success(key)
+            return
+        with self._lock:
+            self._probing.discard(key)
+            self._failures[key] += 1
+            if key in self._opened or self._failures[key] >= self.threshold:
+                if key not in self._opened:
+                    log.warning('Opening circuit for %s after %r', key, exc)
+                self._opened[key] = time.time()
+
+    def call(self, key, f, *args, **kwargs):
+        self.allow(key)
+        try:
+            result = f(*args, **kwargs)
+        except Exception as exc:
+            self.record_failure(key, exc)
+            raise
+        self.record_success(key)
+        return result
+
+
+default_breaker = CircuitBreaker()
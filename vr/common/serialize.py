@@ -0,0 +1,125 @@
+"""
+Serialize many procs at once, as a JSON array or as JSON lines, without
+building the whole document in memory.
+
+Records have the same content as Proc.as_dict(), but are built straight from
+each proc's supervisor data by a fixed schema instead of by inspecting the
+proc's attributes.  orjson is used for encoding when it is installed.
+"""
+import json
+
+import utc
+
+from vr.common import models
+
+try:
+    import orjson
+except ImportError:
+    # optional dependency
+    orjson = None
+
+
+# as_dict() fields read straight from the supervisor data
+_data_fields = (
+    'description', 'exitstatus', 'group', 'logfile', 'name', 'pid',
+    'spawnerr', 'state', 'statename', 'stderr_logfile', 'stdout_logfile',
+)
+# as_dict() timestamp fields, and the supervisor keys they come from
+_timestamp_fields = (
+    ('now', 'now'),
+    ('start_time', 'start'),
+    ('stop_time', 'stop'),
+)
+# as_dict() fields parsed from the proc name
+_name_fields = (
+    'app_name', 'version', 'config_name', 'hash', 'proc_name', 'port',
+)
+
+# as_dict() implementations known to match proc_record()
+_schema_methods = frozenset([models.Proc.as_dict, models.CompactProc.as_dict])
+
+# Upper bound on formatted timestamps kept in memory.  Many procs on a host
+# share a 'now', and many were started by the same deploy.
+TIMESTAMP_CACHE_SIZE = 10000
+_isoformats = {}
+
+
+def _isoformat(ts):
+    # When a timestamp field is inapplicable, Supervisor will put a 0 there.
+    if not ts:
+        return None
+    try:
+        return _isoformats[ts]
+    except KeyError:
+        pass
+    formatted = utc.fromtimestamp(ts).isoformat()
+    if len(_isoformats) >= TIMESTAMP_CACHE_SIZE:
+        _isoformats.clear()
+    _isoformats[ts] = formatted
+    return formatted
+
+
+def proc_record(proc):
+    """
+    Return the dict that proc.as_dict() would.
+    """
+    if type(proc).as_dict not in _schema_methods:
+        # A subclass with its own idea of what to include
+        return proc.as_dict()
+    data = proc._data
+    record = {field: data[field] for field in _data_fields}
+    for field, key in _timestamp_fields:
+        record[field] = _isoformat(data[key])
+    name = data['name']
+    parsed = models._parse_name(name)
+    for field in _name_fields:
+        record[field] = parsed[field]
+    host = proc.host.name
+    record['jsname'] = name.replace('.', 'dot')
+    record['id'] = '%s-%s' % (host, name)
+    record['host'] = host
+    return record
+
+
+def _get_dumps():
+    if orjson is not None:
+        return lambda obj: orjson.dumps(obj).decode('utf-8')
+    return json.JSONEncoder(separators=(',', ':')).encode
+
+
+def iter_json(procs, lines=False):
+    """
+    Yield the procs as JSON text, a piece at a time: a JSON array, or with
+    lines=True, one JSON object per line.
+
+    >>> ''.join(iter_json([]))
+    '[]'
+    """
+    dumps = _get_dumps()
+    records = (dumps(proc_record(proc)) for proc in procs)
+    if lines:
+        for record in records:
+            yield record + '\n'
+        return
+    yield '['
+    for record in records:
+        yield record
+        break
+    for record in records:
+        yield ',' + record
+    yield ']'
+
+
+def dump(procs, fp, lines=False, batch_size=100):
+    """
+    Write the procs to a file-like object as JSON (see iter_json), with one
+    write() per batch_size procs.
+    """
+    batch = []
+    for chunk in iter_json(procs, lines=lines):
+        batch.append(chunk)
+        if len(batch) >= batch_size:
+            fp.write(''.join(batch))
+            batch = []
+    if batch:
+        fp.write(''.join(batch))
@@ -81,10 +81,60 @@ class FakeSupervisor(object):
         self._fake_fault()
         return self.process_info.values()
 
+    def startProcess(self, name):
+        info = self.getProcessInfo(name)
+        if info['statename'] == 'RUNNING':
+            raise xmlrpc_client.Fault(60, 'ALREADY_STARTED: %s' % name)
+        return True
+
+    def stopProcess(self, name):
+        info = self.getProcessInfo(name)
+        if info['statename'] != 'RUNNING':
+            raise xmlrpc_client.Fault(70, 'NOT_RUNNING: %s' % name)
+        return True
+
+
+class FakeSystem(object):
+    def __init__(self, rpc):
+        self.rpc = rpc
+
+    def multicall(self, calls):
+        # Like supervisor, return the result of each successful call as it
+        # is, and a fault struct for each failed one.
+        self.rpc.supervisor._fake_fault()
+        results = []
+        for call in calls:
+            namespace, method = call['methodName'].split('.')
+            f = getattr(getattr(self.rpc, namespace), method)
+            try:
+                results.append(f(*call['params']))
+            except xmlrpc_client.Fault as fault:
+                results.append({
+                    'faultCode': fault.faultCode,
+                    'faultString': fault.faultString,
+                })
+        return results
+
+
+class FakeVR(object):
+    """
+    The vr.agent supervisor plugin.  Fill in 'settings' with the proc.yaml
+    contents to return for each proc name.
+    """
+    def __init__(self):
+        self.settings = {}
+        self.calls = 0
+
+    def get_velociraptor_info(self, name):
+        self.calls += 1
+        return self.settings.get(name)
+
 
 class FakeRPC(object):
     def __init__(self):
         self.supervisor = FakeSupervisor()
+        self.system = FakeSystem(self)
+        self.vr = FakeVR()
 
 
 class tmprepo(object):
@@ -0,0 +1,37 @@
+import subprocess
+
+import pytest
+import redis
+
+
+@pytest.fixture(scope='session')
+def skip_if_redis_missing(request):
+    """
+    As of 1.2.0, the pytest-redis fixture will choke if
+    it can't find redis. Check in advance and skip
+    if redis can't be found.
+    """
+    executable = (
+        request.config.getoption('redis_exec') or
+        request.config.getini('redis_exec')
+    )
+    try:
+        res = subprocess.Popen([executable, '--version']).wait()
+    except Exception:
+        res = True
+    if res:
+        raise pytest.skip("Unable to execute " + executable)
+
+
+@pytest.fixture
+def binary_redisdb(redisdb):
+    """
+    A client for the redisdb server that returns bytes, as needed for
+    binary cache codecs.
+    """
+    pool = redisdb.connection_pool
+    kwargs = dict(pool.connection_kwargs, decode_responses=False)
+    client = redis.StrictRedis(connection_pool=redis.ConnectionPool(
+        connection_class=pool.connection_class, **kwargs))
+    yield client
+    client.connection_pool.disconnect()
@@ -0,0 +1,182 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+from six.moves import xmlrpc_client, xmlrpc_server
+
+from vr.common import rpc
+from vr.common.cache import MsgpackCodec
+from vr.common.aio import AsyncHost, AsyncProc, AsyncServerProxy, _retry
+from vr.common.models import Host, ProcError
+from vr.common.tests import FakeRPC, FakeSupervisor
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class AsyncFakeSupervisor(object):
+    """
+    Wrap FakeSupervisor so that its methods return awaitables.
+    """
+    def __init__(self):
+        self.sync = FakeSupervisor()
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+
+        async def call(*args):
+            self.calls.append((name,) + args)
+            return method(*args)
+        return call
+
+
+class AsyncFakeRPC(object):
+    def __init__(self):
+        self.supervisor = AsyncFakeSupervisor()
+
+
+def test_get_procs():
+    host = AsyncHost('somewhere', AsyncFakeRPC())
+    procs = run(host.get_procs())
+    assert len(procs) == 2
+    assert all(isinstance(proc, AsyncProc) for proc in procs)
+
+
+def test_get_proc():
+    host = AsyncHost('somewhere', AsyncFakeRPC())
+    proc = run(host.get_proc('node_example-v2-local-f96054b7-web-5003'))
+    assert proc.port == 5003
+    assert proc.as_node() == 'somewhere:5003'
+
+
+def test_get_proc_missing():
+    host = AsyncHost('somewhere', AsyncFakeRPC())
+    with pytest.raises(ProcError):
+        run(host.get_proc('nonexistent'))
+
+
+def test_many_in_flight():
+    hosts = [AsyncHost('h%d' % i, AsyncFakeRPC()) for i in range(200)]
+
+    async def scan():
+        return await asyncio.gather(*[host.get_procs() for host in hosts])
+    assert sum(len(procs) for procs in run(scan())) == 400
+
+
+def test_retry_budget_counts_first_attempt():
+    policy = rpc.RetryPolicy(attempts=10, base=0.01, jitter=False, budget=0.1)
+    calls = []
+
+    async def slow():
+        calls.append(time.time())
+        await asyncio.sleep(0.15)
+        raise socket.error('down')
+    with pytest.raises(socket.error):
+        run(_retry(policy, slow))
+    assert len(calls) == 1
+
+
+def test_restart():
+    rpc = AsyncFakeRPC()
+    rpc.supervisor.sync.startProcess = lambda name: True
+    rpc.supervisor.sync.stopProcess = lambda name: True
+    host = AsyncHost('somewhere', rpc)
+    proc = run(host.get_proc('dummyproc'))
+    run(proc.restart())
+    assert rpc.supervisor.calls[-2:] == [
+        ('stopProcess', 'dummyproc'),
+        ('startProcess', 'dummyproc'),
+    ]
+
+
+def test_restart_not_running():
+    rpc = AsyncFakeRPC()
+
+    def stop(name):
+        raise xmlrpc_client.Fault(70, 'NOT_RUNNING: %s' % name)
+    rpc.supervisor.sync.stopProcess = stop
+    rpc.supervisor.sync.startProcess = lambda name: True
+    host = AsyncHost('somewhere', rpc)
+    proc = run(host.get_proc('dummyproc'))
+    run(proc.restart())
+
+
+@pytest.fixture
+def xmlrpc_port():
+    """
+    A real XML-RPC server in a thread, serving the fake supervisor data.
+    """
+    class Supervisor(object):
+        def getAllProcessInfo(self):
+            return list(FakeSupervisor.process_info.values())
+
+        def getProcessInfo(self, name):
+            return FakeSupervisor().getProcessInfo(name)
+
+    server = xmlrpc_server.SimpleXMLRPCServer(
+        ('127.0.0.1', 0), logRequests=False, allow_none=True)
+    server.register_instance(
+        type('RPC', (), {'supervisor': Supervisor()})(),
+        allow_dotted_names=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_server_proxy(xmlrpc_port):
+    proxy = AsyncServerProxy('127.0.0.1', xmlrpc_port)
+    info = run(proxy.supervisor.getProcessInfo('dummyproc'))
+    assert info['pid'] == 5556
+
+
+def test_server_proxy_fault(xmlrpc_port):
+    proxy = AsyncServerProxy('127.0.0.1', xmlrpc_port)
+    with pytest.raises(xmlrpc_client.Fault):
+        run(proxy.supervisor.getProcessInfo('nonexistent'))
+
+
+def test_host_over_port(xmlrpc_port):
+    host = AsyncHost('127.0.0.1', xmlrpc_port)
+    procs = run(host.get_procs(raise_errors=True))
+    assert len(procs) == 2
+
+
+class AsyncRedis(object):
+    """
+    Wrap a Redis client so that its methods return awaitables.
+    """
+    def __init__(self, sync):
+        self.sync = sync
+
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+@pytest.mark.usefixtures('skip_if_redis_missing')
+def test_cache_codec(binary_redisdb):
+    pytest.importorskip('msgpack')
+    Host('somewhere', FakeRPC(), redis_or_url=binary_redisdb,
+         cache_codec=MsgpackCodec()).get_procs()
+    rpc = AsyncFakeRPC()
+    rpc.supervisor.sync.exception = AssertionError('cache not used')
+    host = AsyncHost('somewhere', rpc, redis_or_url=AsyncRedis(binary_redisdb),
+                     cache_codec=MsgpackCodec())
+    procs = run(host.get_procs(check_cache=True))
+    assert len(procs) == 2
+    proc = run(host.get_proc('dummyproc', check_cache=True))
+    assert proc.pid == 5556
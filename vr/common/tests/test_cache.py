@@ -0,0 +1,150 @@
+import threading
+import time
+
+import pytest
+
+from vr.common.cache import LocalCache, JSONCodec, MsgpackCodec
+from vr.common.models import Host
+from vr.common.tests import FakeRPC, FakeSupervisor
+
+
+def test_hit_and_miss():
+    cache = LocalCache()
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.stats() == {
+        'size': 1, 'hits': 1, 'stale_hits': 0, 'misses': 1, 'evictions': 0}
+
+
+def test_lru_eviction():
+    cache = LocalCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # touch 'a' so that 'b' is least recently used
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.evictions == 1
+    assert len(cache) == 2
+
+
+def test_ttl():
+    cache = LocalCache(ttl=0.01)
+    cache.set('a', 1)
+    time.sleep(0.02)
+    assert cache.lookup('a') == (None, False)
+    assert len(cache) == 0
+
+
+def test_stale_within_window():
+    cache = LocalCache(ttl=0.01, stale_ttl=10)
+    cache.set('a', 1)
+    time.sleep(0.02)
+    assert cache.lookup('a') == (1, False)
+    assert cache.get('a') is None
+    assert cache.stale_hits == 2
+
+
+def test_single_revalidation():
+    cache = LocalCache()
+    release = threading.Event()
+    calls = []
+
+    def refresh():
+        calls.append(1)
+        release.wait(1)
+    assert cache.revalidate('a', refresh)
+    assert not cache.revalidate('a', refresh)
+    release.set()
+    for i in range(100):
+        if cache.revalidate('a', lambda: None):
+            break
+        time.sleep(0.01)
+    else:
+        raise AssertionError('refresh never finished')
+    assert calls == [1]
+
+
+def test_host_uses_local_cache():
+    server = FakeRPC()
+    host = Host('somewhere', server, local_cache=LocalCache())
+    host.get_procs()
+    # If we actually hit the RPC (or Redis, which isn't configured), an
+    # exception will be raised.
+    server.supervisor.exception = AssertionError('cache not used')
+    assert len(host.get_procs(check_cache=True)) == 2
+    assert host.get_proc('dummyproc', check_cache=True).pid == 5556
+
+
+def test_local_cache_shared_between_hosts():
+    cache = LocalCache()
+    server = FakeRPC()
+    Host('somewhere', server, local_cache=cache).get_procs()
+    server.supervisor.exception = AssertionError('cache not used')
+    host = Host('somewhere', server, local_cache=cache)
+    assert len(host.get_procs(check_cache=True)) == 2
+
+
+def test_stale_while_revalidate():
+    cache = LocalCache(ttl=0.01, stale_ttl=60)
+    server = FakeRPC()
+    info = dict(server.supervisor.process_info)
+    server.supervisor.process_info = info
+    host = Host('somewhere', server, local_cache=cache)
+    host.get_procs()
+    time.sleep(0.02)
+
+    del info['dummyproc']
+    # The stale entry is served right away...
+    assert len(host.get_procs(check_cache=True)) == 2
+    # ...while a background refresh replaces it.
+    for i in range(100):
+        if cache.get(host.cache_key) is not None:
+            break
+        time.sleep(0.01)
+    assert len(host.get_procs(check_cache=True)) == 1
+
+
+@pytest.mark.parametrize('name', FakeSupervisor.process_info)
+def test_json_codec_round_trip(name):
+    codec = JSONCodec()
+    data = FakeSupervisor.process_info[name]
+    assert codec.loads(codec.dumps(data)) == data
+
+
+@pytest.mark.parametrize('name', FakeSupervisor.process_info)
+def test_msgpack_codec_round_trip(name):
+    pytest.importorskip('msgpack')
+    codec = MsgpackCodec()
+    data = FakeSupervisor.process_info[name]
+    encoded = codec.dumps(data)
+    assert encoded[:1] == MsgpackCodec.version
+    assert len(encoded) < len(JSONCodec().dumps(data))
+    assert codec.loads(encoded) == data
+
+
+def test_msgpack_codec_reads_json():
+    data = FakeSupervisor.process_info['dummyproc']
+    legacy = JSONCodec().dumps(data)
+    assert MsgpackCodec().loads(legacy) == data
+    assert MsgpackCodec().loads(legacy.encode('utf-8')) == data
+
+
+@pytest.mark.usefixtures('skip_if_redis_missing')
+def test_msgpack_codec_through_redis(binary_redisdb):
+    pytest.importorskip('msgpack')
+    server = FakeRPC()
+    writer = Host('somewhere', server, redis_or_url=binary_redisdb,
+                  cache_codec=MsgpackCodec())
+    writer.get_procs()
+    raw = binary_redisdb.hget(writer.cache_key, 'dummyproc')
+    assert raw[:1] == MsgpackCodec.version
+
+    server.supervisor.exception = AssertionError('cache not used')
+    reader = Host('somewhere', server, redis_or_url=binary_redisdb,
+                  cache_codec=MsgpackCodec())
+    procs = reader.get_procs(check_cache=True)
+    assert len(procs) == 2
+    assert reader.get_proc('dummyproc', check_cache=True).pid == 5556
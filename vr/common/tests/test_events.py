@@ -0,0 +1,256 @@
+import json
+import socket
+import threading
+
+import pytest
+from six.moves import BaseHTTPServer, socketserver
+
+from vr.common import rpc
+from vr.common.events import (
+    Detached, Event, EventFilter, EventHub, EventStream, get_hub, parse_lines,
+)
+
+
+def sse(event_id, data, event=None):
+    lines = ['id: %s' % event_id]
+    if event:
+        lines.append('event: %s' % event)
+    lines.append('data: %s' % json.dumps(data))
+    return '\n'.join(lines) + '\n\n'
+
+
+@pytest.fixture
+def server():
+    """
+    An SSE server.  Each connection is sent the next chunk of text in
+    'server.responses' and closed, and the Last-Event-ID header it sent is
+    recorded in 'server.last_ids'.
+    """
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            srv.last_ids.append(self.headers.get('Last-Event-ID'))
+            body = srv.responses.pop(0) if srv.responses else ''
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            self.wfile.write(body.encode('utf-8'))
+
+        def log_message(self, *args):
+            pass
+
+    class ThreadedServer(
+            socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    srv = ThreadedServer(('127.0.0.1', 0), Handler)
+    srv.responses = []
+    srv.last_ids = []
+    srv.url = 'http://127.0.0.1:%d/api/streams/events/' % srv.server_port
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+fast_retry = rpc.RetryPolicy(base=0.01, cap=0.01)
+
+
+def test_parse_lines():
+    lines = [
+        ': keep-alive', 'retry: 2500', 'id: 7', 'event: deploy',
+        'data: line one', 'data:line two', '', '', 'data: no id change', '',
+    ]
+    retries = []
+    events = list(parse_lines(lines, retries.append))
+    assert [(e.id, e.event, e.data) for e in events] == [
+        ('7', 'deploy', 'line one\nline two'),
+        ('7', 'message', 'no id change'),
+    ]
+    assert retries == [2.5]
+
+
+def test_resume_with_last_event_id(server):
+    server.responses = [
+        sse(1, {'n': 1}) + sse(2, {'n': 2}),
+        sse(3, {'n': 3}),
+    ]
+    stream = EventStream(server.url, retry_policy=fast_retry)
+    events = iter(stream)
+    assert [next(events)['n'] for _ in range(3)] == [1, 2, 3]
+    events.close()
+    assert server.last_ids[:2] == [None, '2']
+    stats = stream.stats()
+    assert stats['received'] == stats['delivered'] == 3
+    assert stats['reconnects'] >= 1
+
+
+def test_filters_before_decoding(server):
+    server.responses = [
+        sse(1, {'tags': ['deploy', 'app1']}) +
+        'id: 2\ndata: not json, and not for app1\n\n' +
+        sse(3, {'tags': ['deploy', 'app2'], 'message': 'app1'}) +
+        sse(4, {'tags': ['app1']}, event='ignored') +
+        sse(5, {'tags': ['app1'], 'n': 5}),
+    ]
+    stream = EventStream(
+        server.url, tags=['app1'], event_types=['message'],
+        retry_policy=fast_retry)
+    events = iter(stream)
+    assert next(events) == {'tags': ['deploy', 'app1']}
+    assert next(events)['n'] == 5
+    events.close()
+    assert stream.filtered == 3
+
+
+@pytest.mark.parametrize('overflow,expected', [
+    ('drop_newest', [0, 1]),
+    ('drop_oldest', [2, 3]),
+])
+def test_overflow(overflow, expected):
+    stream = EventStream('http://example.invalid/', max_queue=2,
+                         overflow=overflow)
+    for n in range(4):
+        stream._offer(Event(n, data=json.dumps(n)))
+    queued = list(stream._queue.queue)
+    assert [event.json() for event in queued] == expected
+    assert stream.dropped == 2
+
+
+def test_filter_non_object_events():
+    keep = EventFilter(tags=['app1'])
+    assert not keep(Event(data='["app1"]'))
+    assert not keep(Event(data='"app1"'))
+
+
+def test_read_timeout_reconnects():
+    """
+    A connection that goes quiet without closing is dropped and resumed.
+    """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    connections = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except socket.error:
+                return
+            connections.append(conn)
+            conn.recv(65536)
+            body = sse(len(connections), {})
+            response = (
+                'HTTP/1.1 200 OK\r\n'
+                'Content-Type: text/event-stream\r\n'
+                'Transfer-Encoding: chunked\r\n\r\n'
+                '%x\r\n%s\r\n' % (len(body), body))
+            conn.sendall(response.encode('utf-8'))
+            # ...and then nothing, but the connection stays open.
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+
+    url = 'http://127.0.0.1:%d/' % listener.getsockname()[1]
+    stream = EventStream(url, timeout=(1, 0.1), retry_policy=fast_retry)
+    events = stream.iter_events()
+    assert [next(events).id for _ in range(2)] == ['1', '2']
+    events.close()
+    listener.close()
+    for conn in connections:
+        conn.close()
+
+
+def consume(events):
+    """
+    Read events on another thread, returning what was read before the
+    iterator ended, or None if it didn't end within a few seconds.
+    """
+    received = []
+    thread = threading.Thread(
+        target=lambda: received.extend(event.id for event in events))
+    thread.daemon = True
+    thread.start()
+    thread.join(3)
+    return None if thread.is_alive() else received
+
+
+def test_close_with_full_queue():
+    stream = EventStream('http://127.0.0.1:1/', max_queue=2,
+                         retry_policy=fast_retry)
+    events = stream.iter_events()
+    for n in range(2):
+        stream._offer(Event(str(n), data='{}'))
+    stream.close()
+    assert consume(events) == ['0', '1']
+
+
+def test_bad_overflow():
+    with pytest.raises(ValueError):
+        EventStream('http://example.invalid/', overflow='explode')
+
+
+def test_hub_fans_out(server):
+    server.responses = [
+        sse(1, {'tags': ['app1']}) + sse(2, {'tags': ['app2']}) +
+        sse(3, {'tags': ['app1', 'app2']}),
+    ]
+    hub = EventHub(server.url, retry_policy=fast_retry)
+    first = hub.subscribe(tags=['app1'])
+    second = hub.subscribe(tags=['app2'])
+    firsts = iter(first.iter_events())
+    seconds = iter(second.iter_events())
+    assert [next(firsts).id for _ in range(2)] == ['1', '3']
+    assert [next(seconds).id for _ in range(2)] == ['2', '3']
+    # Only one connection to the server.
+    assert server.last_ids == [None]
+    firsts.close()
+    assert hub.subscriptions == [second]
+    hub.close()
+    assert list(seconds) == []
+
+
+def test_hub_detaches_slow_subscriber(server):
+    server.responses = [
+        ''.join(sse(n, {'n': n}) for n in range(10)),
+    ]
+    hub = EventHub(server.url, retry_policy=fast_retry)
+    slow = hub.subscribe(max_queue=2)
+    fast = hub.subscribe(max_queue=20)
+    events = iter(fast)
+    assert [next(events)['n'] for _ in range(10)] == list(range(10))
+    # The slow subscriber gets what fit in its queue, then is cut off.
+    received = []
+    with pytest.raises(Detached):
+        for event in slow:
+            received.append(event['n'])
+    assert received == [0, 1]
+    assert hub.detached == 1
+    hub.close()
+
+
+def test_hub_close_with_full_queue():
+    hub = EventHub('http://127.0.0.1:1/', retry_policy=fast_retry)
+    subscription = hub.subscribe(max_queue=2)
+    for n in range(2):
+        subscription._offer(Event(str(n), data='{}'))
+    hub.close()
+    assert consume(subscription.iter_events()) == ['0', '1']
+
+
+def test_subscription_closed_from_another_thread():
+    hub = EventHub('http://127.0.0.1:1/', retry_policy=fast_retry)
+    subscription = hub.subscribe(max_queue=2)
+    subscription._offer(Event('0', data='{}'))
+    events = subscription.iter_events()
+    assert next(events).id == '0'
+    subscription.close()
+    assert consume(events) == []
+    hub.close()
+
+
+def test_get_hub_shared():
+    url = 'http://example.invalid/api/streams/events/'
+    assert get_hub(url) is get_hub(url)
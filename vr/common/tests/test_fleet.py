@@ -0,0 +1,291 @@
+import time
+import socket
+import threading
+
+import pytest
+import redis
+
+from vr.common import rpc
+from vr.common.models import Host
+from vr.common.fleet import (
+    Fleet, FleetIndex, HostTimeout, RestartError, RollingRestart,
+    get_cached_procs,
+)
+from vr.common.tests import FakeRPC
+
+
+class SlowRPC(FakeRPC):
+    def __init__(self, delay):
+        super(SlowRPC, self).__init__()
+        get_all = self.supervisor.getAllProcessInfo
+
+        def slow_get_all():
+            time.sleep(delay)
+            return get_all()
+        self.supervisor.getAllProcessInfo = slow_get_all
+
+
+def test_get_procs_all_hosts():
+    fleet = Fleet([Host('h%d' % i, FakeRPC()) for i in range(5)])
+    result = fleet.get_procs()
+    assert result.complete
+    assert sorted(result.results) == ['h0', 'h1', 'h2', 'h3', 'h4']
+    assert len(result.procs) == 10
+
+
+def test_hostnames_build_hosts():
+    fleet = Fleet(['somewhere'], rpc_or_port=9002, host_timeout=3)
+    host, = fleet.hosts
+    assert isinstance(host, Host)
+    assert host.rpc_timeout == 3
+
+
+def test_error_map(monkeypatch):
+    monkeypatch.setattr(Host, 'retry_policy', rpc.RetryPolicy(attempts=1))
+    monkeypatch.setattr(Host, 'circuit_breaker', rpc.CircuitBreaker())
+    bad = FakeRPC()
+    bad.supervisor.exception = socket.error('connection refused')
+    fleet = Fleet([Host('good', FakeRPC()), Host('bad', bad)])
+    result = fleet.get_procs()
+    assert not result.complete
+    assert list(result.results) == ['good']
+    assert isinstance(result.errors['bad'], socket.error)
+
+
+def test_host_timeout_returns_partial_results():
+    hosts = [Host('fast', FakeRPC()), Host('slow', SlowRPC(1))]
+    fleet = Fleet(hosts, host_timeout=0.2)
+    result = fleet.get_procs()
+    assert list(result.results) == ['fast']
+    assert isinstance(result.errors['slow'], HostTimeout)
+    assert result.elapsed < 1
+
+
+@pytest.mark.parametrize('max_workers', [1, 8])
+def test_overall_timeout(max_workers):
+    hosts = [Host('h%d' % i, SlowRPC(0.5)) for i in range(4)]
+    fleet = Fleet(hosts, max_workers=max_workers, timeout=0.2)
+    result = fleet.get_procs()
+    assert not result.results
+    assert set(result.errors) == set(h.name for h in hosts)
+    assert result.elapsed < 0.5
+
+
+@pytest.mark.usefixtures('skip_if_redis_missing')
+class TestCachedProcs:
+
+    @pytest.fixture(autouse=True)
+    def hosts(self, redisdb):
+        self.redis = redisdb
+        self.hosts = [
+            Host('h%d' % i, FakeRPC(), redis_or_url=redisdb)
+            for i in range(4)
+        ]
+
+    def test_get_cached_procs(self):
+        for host in self.hosts[:2]:
+            host.get_procs()
+        cached, missed = get_cached_procs(self.hosts)
+        assert sorted(cached) == ['h0', 'h1']
+        assert len(cached['h0']) == 2
+        assert missed == self.hosts[2:]
+
+    def test_single_round_trip(self, monkeypatch):
+        calls = []
+        orig = type(self.redis).pipeline
+
+        def pipeline(redis, *args, **kwargs):
+            calls.append(args)
+            return orig(redis, *args, **kwargs)
+        monkeypatch.setattr(type(self.redis), 'pipeline', pipeline)
+        get_cached_procs(self.hosts)
+        assert len(calls) == 1
+
+    def test_fleet_only_rpcs_misses(self):
+        for host in self.hosts[:2]:
+            host.get_procs()
+            host.supervisor.exception = AssertionError('cache not used')
+        result = Fleet(self.hosts).get_procs(check_cache=True)
+        assert result.complete
+        assert len(result.procs) == 8
+        # The misses are now cached too
+        cached, missed = get_cached_procs(self.hosts)
+        assert not missed
+
+    def test_hosts_without_redis_miss(self):
+        host = Host('plain', FakeRPC())
+        cached, missed = get_cached_procs([host])
+        assert missed == [host]
+
+
+def test_fleet_shares_redis_client():
+    fleet = Fleet(['h0', 'h1', 'h2'], rpc_or_port=FakeRPC(),
+                  redis_or_url='redis://localhost:6379/0')
+    assert len(set(id(host.redis) for host in fleet)) == 1
+
+
+def test_cached_procs_grouped_by_server(monkeypatch):
+    # Hosts made separately from the same URL each get their own client.
+    url = 'redis://localhost:6379/0'
+    hosts = [Host('h%d' % i, FakeRPC(), redis_or_url=url) for i in range(3)]
+    calls = []
+
+    def pipeline(client, *args, **kwargs):
+        calls.append(client)
+        raise redis.ConnectionError('not really connecting')
+    monkeypatch.setattr(redis.StrictRedis, 'pipeline', pipeline)
+    cached, missed = get_cached_procs(hosts)
+    assert len(calls) == 1
+    assert missed == hosts
+
+
+def restartable_host(name, statename='RUNNING', delay=0):
+    """
+    A Host with procs 'a', 'b' and 'c', each coming up in 'statename' when
+    started.
+    """
+    server = FakeRPC()
+    template = server.supervisor.process_info['dummyproc']
+    server.supervisor.process_info = {
+        proc: dict(template, name=proc, group=proc) for proc in 'abc'
+    }
+
+    def restart(name):
+        time.sleep(delay)
+        server.supervisor.process_info[name]['statename'] = statename
+        return True
+    server.supervisor.stopProcess = restart
+    server.supervisor.startProcess = restart
+    return Host(name, server)
+
+
+def test_rolling_restart_waves():
+    hosts = [restartable_host('h%d' % i) for i in range(3)]
+    procs = [proc for host in hosts for proc in host.get_procs()]
+    restart = RollingRestart(procs, max_in_flight=2, per_host=1)
+    waves = list(restart.waves(procs))
+    assert all(len(wave) <= 2 for wave in waves)
+    for wave in waves:
+        assert len(set(proc.host.name for proc in wave)) == len(wave)
+    assert sum(len(wave) for wave in waves) == 9
+
+    result = restart.run()
+    assert result.complete
+    assert sorted(result.succeeded) == sorted(proc.id for proc in procs)
+    assert len(result.waves) == len(waves)
+
+
+def test_rolling_restart_concurrent():
+    hosts = [restartable_host('h%d' % i, delay=0.2) for i in range(4)]
+    procs = [host.get_proc('a') for host in hosts]
+    result = RollingRestart(procs, max_in_flight=4).run()
+    assert result.complete
+    assert len(result.waves) == 1
+    # Stop and start take 0.2s each, on all hosts at once.
+    assert result.elapsed < 0.8
+    wave, = result.waves
+    assert wave.restart_time >= 0.4
+
+
+def test_rolling_restart_error_budget():
+    bad = restartable_host('bad', statename='FATAL')
+    good = restartable_host('good')
+    procs = bad.get_procs() + good.get_procs()
+    result = RollingRestart(procs, max_in_flight=1, max_errors=1).run()
+    assert result.aborted
+    assert len(result.errors) == 2
+    assert all(isinstance(e, RestartError) for e in result.errors.values())
+    assert len(result.skipped) == 4
+    assert result.waves[0].failures == 1
+
+
+def test_rolling_restart_running_timeout(monkeypatch):
+    monkeypatch.setattr(RollingRestart, 'poll_interval', 0.01)
+    host = restartable_host('slow', statename='STARTING')
+    restart = RollingRestart(
+        [host.get_proc('a')], running_timeout=0.05, max_errors=5)
+    result = restart.run()
+    error, = result.errors.values()
+    assert 'not RUNNING' in str(error)
+
+    restart.wait_running = False
+    assert restart.run().complete
+
+
+def test_rolling_restart_poll_failure(monkeypatch):
+    monkeypatch.setattr(RollingRestart, 'poll_interval', 0.01)
+    host = restartable_host('flaky')
+    supervisor = host.rpc.supervisor
+    get_all = supervisor.getAllProcessInfo
+    # Enough failures for one whole get_procs(), retries included.
+    failures = [socket.error('reset')] * host.retry_policy.attempts
+    restart = supervisor.startProcess
+
+    def start(name):
+        failures_left[:] = failures
+        return restart(name)
+
+    def flaky_get_all():
+        if failures_left:
+            raise failures_left.pop()
+        return get_all()
+    failures_left = []
+    supervisor.startProcess = start
+    supervisor.getAllProcessInfo = flaky_get_all
+    result = RollingRestart(host.get_procs(), max_in_flight=3).run()
+    assert result.complete
+    assert len(result.succeeded) == 3
+    assert not failures_left
+
+
+NODE_PROC = 'node_example-v2-local-f96054b7-web-5003'
+
+
+def test_fleet_index_lookups():
+    fleet = Fleet([Host('h%d' % i, FakeRPC()) for i in range(3)])
+    index = FleetIndex.from_fleet_result(fleet.get_procs())
+    assert len(index) == 6
+    assert index.hosts(app_name='node_example') == set(['h0', 'h1', 'h2'])
+    procs = index.find(hash='f96054b7', host='h1')
+    assert [proc.id for proc in procs] == ['h1-' + NODE_PROC]
+    assert index.by_port('h2', 5003).id == 'h2-' + NODE_PROC
+    assert index.by_port('h2', 5004) is None
+    assert index.find(app_name='nothing') == []
+    assert len(index.find()) == 6
+    assert index.values('version') == set(['v2', 'UNKNOWN'])
+
+
+def test_fleet_index_updates():
+    host = Host('h0', FakeRPC())
+    index = FleetIndex(host.get_procs())
+
+    proc = host.get_proc(NODE_PROC)
+    proc.statename = 'RUNNING'
+    index.add(proc)
+    assert len(index) == 2
+    assert index.get(proc.id).statename == 'RUNNING'
+
+    index.update_host('h0', [proc])
+    assert 'h0-dummyproc' not in index
+    assert index.values('app_name') == set(['node_example'])
+
+    index.remove(proc.id)
+    assert len(index) == 0
+    assert index.by_port('h0', 5003) is None
+    assert index.values('host') == set()
+
+
+def test_fleet_watch():
+    hosts = [restartable_host('h%d' % i) for i in range(3)]
+    stop = threading.Event()
+    events = Fleet(hosts).watch(min_interval=0.01, stop=stop)
+    # Stop 'a' on every host, after the watchers' first polls.
+    for host in hosts:
+        info = host.supervisor.process_info
+        stopped = dict(info['a'], statename='STOPPED', state=0, pid=0)
+        threading.Timer(0.2, info.__setitem__, ('a', stopped)).start()
+    seen = sorted((e.host.name, e.name, e.kind) for e in
+                  [next(events) for _ in hosts])
+    assert seen == [('h%d' % i, 'a', 'stopped') for i in range(3)]
+    events.close()
+    assert stop.is_set()
@@ -1,13 +1,22 @@
 import unittest
+import collections
+import copy
+import io
 import json
-import subprocess
+import threading
+import time
 
 import redis
 import pytest
+import requests
 import utc
+from six.moves import xmlrpc_client
 
-from vr.common.models import Host, ProcError, Build
-from vr.common.tests import FakeRPC
+from vr.common import models, paths, rpc
+from vr.common.models import (
+    Host, Proc, CompactProc, ProcError, Build, QueryResult, Velociraptor,
+)
+from vr.common.tests import FakeRPC, FakeSupervisor
 
 
 def test_host_init_rpc():
@@ -144,6 +153,198 @@ class FakeProcCase(unittest.TestCase):
         assert self.nodeproc.shortname() == 'node_example-v2-web'
 
 
+def test_get_proc_single_rpc():
+    server = FakeRPC()
+    host = Host('somewhere', server)
+    server.supervisor.getAllProcessInfo = None
+    assert host.get_proc('dummyproc').pid == 5556
+
+
+def test_get_proc_bad_name_not_retried():
+    server = FakeRPC()
+    host = Host('somewhere', server)
+    calls = []
+    get_info = server.supervisor.getProcessInfo
+
+    def getProcessInfo(name):
+        calls.append(name)
+        return get_info(name)
+    server.supervisor.getProcessInfo = getProcessInfo
+    with pytest.raises(ProcError):
+        host.get_proc('nonexistent')
+    assert calls == ['nonexistent']
+
+
+def test_start_procs_multicall():
+    server = FakeRPC()
+    host = Host('somewhere', server)
+    calls = []
+    multicall = server.system.multicall
+
+    def record(batch):
+        calls.append(batch)
+        return multicall(batch)
+    server.system.multicall = record
+    results = host.start_procs(
+        ['dummyproc', 'node_example-v2-local-f96054b7-web-5003'])
+    # One round trip, and already started counts as success.
+    assert len(calls) == 1
+    assert results == {
+        'dummyproc': None,
+        'node_example-v2-local-f96054b7-web-5003': None,
+    }
+
+
+def test_stop_procs_reports_faults():
+    host = Host('somewhere', FakeRPC())
+    results = host.stop_procs(
+        ['node_example-v2-local-f96054b7-web-5003', 'nonexistent'])
+    assert results['node_example-v2-local-f96054b7-web-5003'] is None
+    fault = results['nonexistent']
+    assert fault.faultString == 'BAD_NAME: nonexistent'
+    assert host.stop_procs([]) == {}
+
+
+def test_restart_procs_skips_failed_stops():
+    server = FakeRPC()
+    host = Host('somewhere', server)
+    started = []
+    server.supervisor.startProcess = started.append
+    results = host.restart_procs(['dummyproc', 'nonexistent'])
+    assert started == ['dummyproc']
+    assert results['dummyproc'] is None
+    assert results['nonexistent'].faultString.startswith('BAD_NAME')
+
+
+def node_settings():
+    return {
+        'app_name': 'node_example',
+        'version': 'v2',
+        'config_name': 'local',
+        'release_hash': 'f96054b7',
+        'proc_name': 'web',
+        'port': 5003,
+        'host': 'somewhere',
+    }
+
+
+@pytest.fixture
+def settings_cache(monkeypatch):
+    monkeypatch.setattr(
+        Proc, 'settings_cache', models.cache.LocalCache(ttl=60))
+
+
+@pytest.mark.usefixtures('settings_cache')
+def test_settings_memoized():
+    server = FakeRPC()
+    name = 'node_example-v2-local-f96054b7-web-5003'
+    server.vr.settings[name] = node_settings()
+    host = Host('somewhere', server)
+    proc = host.get_proc(name)
+    assert proc.settings.port == 5003
+    assert proc.settings is host.get_proc(name).settings
+    assert server.vr.calls == 1
+    # Procs not named by Velociraptor aren't cached.
+    dummy = host.get_proc('dummyproc')
+    assert dummy.settings is None
+    assert dummy.settings is None
+    assert server.vr.calls == 3
+
+
+@pytest.mark.usefixtures('settings_cache')
+def test_get_settings_multicall():
+    server = FakeRPC()
+    name = 'node_example-v2-local-f96054b7-web-5003'
+    server.vr.settings[name] = node_settings()
+    host = Host('somewhere', server)
+    settings = host.get_settings()
+    assert settings['dummyproc'] is None
+    assert settings[name].app_name == 'node_example'
+    server.system.multicall = None
+    # Now cached, so no further RPC.
+    assert host.get_proc(name).settings is settings[name]
+    assert host.get_settings([name]) == {name: settings[name]}
+    assert server.vr.calls == 2
+
+
+@pytest.mark.usefixtures('settings_cache')
+def test_get_settings_fault():
+    server = FakeRPC()
+    name = 'node_example-v2-local-f96054b7-web-5003'
+    server.vr.settings[name] = node_settings()
+    get_info = server.vr.get_velociraptor_info
+
+    def get_velociraptor_info(proc_name):
+        if proc_name == 'dummyproc':
+            raise xmlrpc_client.Fault(10, 'BAD_NAME: dummyproc')
+        return get_info(proc_name)
+    server.vr.get_velociraptor_info = get_velociraptor_info
+    settings = Host('somewhere', server).get_settings()
+    assert settings['dummyproc'] is None
+    assert settings[name].port == 5003
+
+
+def test_parse_name_round_trip():
+    name = 'node_example-v2-local-f96054b7-web-5003'
+    parsed = Proc.parse_name(name)
+    assert Proc.format_name(parsed) == name
+    # Callers get their own copy of the cached result.
+    parsed['port'] = 1
+    assert Proc.parse_name(name)['port'] == 5003
+
+
+def test_format_container_name_matches_settings():
+    Settings = collections.namedtuple('Settings', [
+        'app_name', 'version', 'config_name', 'release_hash', 'proc_name',
+        'port'])
+    settings = Settings('node_example', 'v2', 'local', 'f96054b7', 'web', 5003)
+    name = paths.get_container_name(settings)
+    assert name == 'node_example-v2-local-f96054b7-web-5003'
+    assert Proc.name_to_shortname(name) == 'node_example-v2-web'
+
+
+def test_name_cache_bounded(monkeypatch):
+    monkeypatch.setattr(models, 'NAME_CACHE_SIZE', 5)
+    monkeypatch.setattr(models, '_parsed_names', {})
+    monkeypatch.setattr(models, '_shortnames', {})
+    for port in range(20):
+        name = 'app-v1-prod-abc-web-%d' % port
+        assert Proc.parse_name(name)['port'] == port
+        assert Proc.name_to_shortname(name) == 'app-v1-web'
+    assert len(models._parsed_names) <= 5
+    assert len(models._shortnames) <= 5
+
+
+@pytest.mark.parametrize('name', FakeSupervisor.process_info)
+def test_compact_proc_matches_proc(name):
+    host = Host('somewhere', FakeRPC())
+    data = host.supervisor.process_info[name]
+    proc = Proc(host, data)
+    compact = CompactProc(host, data)
+    assert compact.as_dict() == proc.as_dict()
+    assert compact.as_json() == proc.as_json()
+    for attr in Proc.fields:
+        assert getattr(compact, attr) == getattr(proc, attr)
+    assert compact.shortname() == proc.shortname()
+    assert repr(compact) == repr(proc)
+
+
+def test_compact_proc_slotted():
+    host = Host('somewhere', FakeRPC())
+    proc = CompactProc(host, host.supervisor.process_info['dummyproc'])
+    assert not hasattr(proc, '__dict__')
+    with pytest.raises(AttributeError):
+        proc.foo = 'bar'
+
+
+def test_host_proc_class(monkeypatch):
+    monkeypatch.setattr(Host, 'proc_class', CompactProc)
+    host = Host('somewhere', FakeRPC())
+    procs = host.get_procs()
+    assert all(isinstance(proc, CompactProc) for proc in procs)
+    assert isinstance(host.get_proc('dummyproc'), CompactProc)
+
+
 def test_datetime_none():
     server = FakeRPC()
     server.supervisor.process_info['dummyproc']['now'] = 0
@@ -152,23 +353,41 @@ def test_datetime_none():
     assert proc.now is None
 
 
-@pytest.fixture(scope='session')
-def skip_if_redis_missing(request):
-    """
-    As of 1.2.0, the pytest-redis fixture will choke if
-    it can't find redis. Check in advance and skip
-    if redis can't be found.
-    """
-    executable = (
-        request.config.getoption('redis_exec') or
-        request.config.getini('redis_exec')
-    )
-    try:
-        res = subprocess.Popen([executable, '--version']).wait()
-    except Exception:
-        res = True
-    if res:
-        raise pytest.skip("Unable to execute " + executable)
+def test_watch_events():
+    server = FakeRPC()
+    first = copy.deepcopy(FakeSupervisor.process_info)
+    second = copy.deepcopy(first)
+    second['dummyproc'].update(statename='STOPPED', state=0, pid=0)
+    second['newproc'] = dict(second['dummyproc'], name='newproc')
+    del second['node_example-v2-local-f96054b7-web-5003']
+    third = copy.deepcopy(second)
+    third['dummyproc'].update(statename='RUNNING', state=20, pid=42)
+    third['dummyproc']['now'] += 5
+    snapshots = iter([first, second, second, third])
+    server.supervisor.getAllProcessInfo = \
+        lambda: list(next(snapshots).values())
+
+    events = Host('somewhere', server).watch(min_interval=0.01)
+    changes = sorted((event.kind, event.name) for event in [
+        next(events), next(events), next(events)])
+    assert changes == [
+        ('appeared', 'newproc'),
+        ('removed', 'node_example-v2-local-f96054b7-web-5003'),
+        ('stopped', 'dummyproc'),
+    ]
+    # The unchanged poll yields nothing; the next one sees the restart.
+    event = next(events)
+    assert event.kind == 'started'
+    assert event.proc.pid == 42
+    assert event.old_data['pid'] == 0
+    events.close()
+
+
+def test_watch_stop():
+    stop = threading.Event()
+    stop.set()
+    host = Host('somewhere', FakeRPC())
+    assert list(host.watch(stop=stop)) == []
 
 
 @pytest.fixture
@@ -238,6 +457,120 @@ class TestRedisCache:
         with pytest.raises(ProcError):
             self.host.get_proc('nonexistent')
 
+    def test_delta_writes_only_changes(self):
+        host = Host(
+            'somewhere', self.server, redis_or_url=self.redis,
+            redis_cache_delta=True)
+        info = copy.deepcopy(self.supervisor.process_info)
+        self.supervisor.process_info = info
+        host.get_procs()
+        pubsub = self.redis.pubsub()
+        pubsub.subscribe(host.cache_channel)
+        pubsub.get_message(timeout=1)
+
+        info['dummyproc']['now'] += 10
+        info['dummyproc']['statename'] = 'STOPPED'
+        for data in info.values():
+            data['description'] = 'uptime changed'
+        del info['node_example-v2-local-f96054b7-web-5003']
+        host.get_procs()
+
+        cached = self.redis.hgetall(host.cache_key)
+        assert list(cached) == ['dummyproc']
+        assert json.loads(cached['dummyproc']) == info['dummyproc']
+        msg = pubsub.get_message(timeout=1)
+        assert json.loads(msg['data']) == {
+            'host': 'somewhere',
+            'changed': ['dummyproc'],
+            'removed': ['node_example-v2-local-f96054b7-web-5003'],
+        }
+
+    def test_delta_ignores_volatile_fields(self):
+        host = Host(
+            'somewhere', self.server, redis_or_url=self.redis,
+            redis_cache_delta=True)
+        info = copy.deepcopy(self.supervisor.process_info)
+        self.supervisor.process_info = info
+        host.get_procs()
+        before = self.redis.hgetall(host.cache_key)
+
+        info['dummyproc']['now'] += 10
+        procs = host.get_procs()
+        # Callers get fresh data, but the cache isn't rewritten
+        assert self.redis.hgetall(host.cache_key) == before
+        dummy, = [p for p in procs if p.name == 'dummyproc']
+        assert dummy._data['now'] == info['dummyproc']['now']
+
+    def test_watch_uses_notices(self):
+        watcher = Host(
+            'somewhere', self.server, redis_or_url=self.redis,
+            redis_cache_delta=True)
+        info = copy.deepcopy(self.supervisor.process_info)
+        self.supervisor.process_info = info
+        events = watcher.watch(min_interval=5)
+        # The watcher's first poll happens on the first next(); refresh the
+        # cache from elsewhere once it's waiting for notices.
+        other = FakeRPC()
+        other.supervisor.process_info = copy.deepcopy(info)
+        other.supervisor.process_info['dummyproc']['statename'] = 'FATAL'
+        other.supervisor.process_info['dummyproc']['state'] = 200
+        refresher = Host(
+            'somewhere', other, redis_or_url=self.redis,
+            redis_cache_delta=True)
+        timer = threading.Timer(0.2, refresher.get_procs)
+        timer.start()
+        start = time.time()
+        event = next(events)
+        assert time.time() - start < 2
+        assert (event.kind, event.name) == ('fatal', 'dummyproc')
+        events.close()
+        timer.join()
+
+    def test_proc_miss_on_cached_host_fetches_one(self):
+        self.host.get_procs()
+        self.redis.hdel(self.host.cache_key, 'dummyproc')
+        # Only the single-proc call should be made
+        self.supervisor.getAllProcessInfo = None
+        proc = self.host.get_proc('dummyproc', check_cache=True)
+        assert proc.pid == 5556
+        cached = self.redis.hget(self.host.cache_key, 'dummyproc')
+        assert json.loads(cached) == self.supervisor.process_info['dummyproc']
+
+    def test_single_proc_not_cached_alone(self):
+        # Without the rest of the host's procs, one proc isn't cached, or it
+        # would look like the host's only proc.
+        self.host.get_proc('dummyproc')
+        assert not self.redis.exists(self.host.cache_key)
+
+    def test_single_flight_refresh(self):
+        # Concurrent misses should make only one supervisor call
+        calls = []
+        get_all = self.supervisor.getAllProcessInfo
+
+        def slow_get_all():
+            calls.append(1)
+            time.sleep(0.2)
+            return get_all()
+        self.supervisor.getAllProcessInfo = slow_get_all
+
+        results = []
+
+        def get_procs():
+            host = Host('somewhere', self.server, redis_or_url=self.redis)
+            results.append(host.get_procs(check_cache=True))
+        threads = [threading.Thread(target=get_procs) for i in range(5)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        assert len(calls) == 1
+        assert [len(procs) for procs in results] == [2] * 5
+        assert not self.redis.exists(self.host.cache_key + ':lock')
+
+    def test_lock_holder_timeout_falls_back(self):
+        # If another refresher never finishes, waiters fetch for themselves
+        self.redis.set(self.host.cache_key + ':lock', 'someone-else')
+        self.host.cache_lock_wait = 0.1
+        assert len(self.host.get_procs(check_cache=True)) == 2
+
 
 def test_build_sets():
     """
@@ -247,3 +580,174 @@ def test_build_sets():
     b2 = Build(None, {'app': 'foo'})
     b3 = Build(None, {'app': 'bar'})
     assert set([b1, b2, b3]) == set([b1, b3])
+
+
+class FakeResponse(object):
+    def __init__(self, doc):
+        self.doc = doc
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.doc
+
+
+class FakeAPI(object):
+    """
+    Enough of Velociraptor to page through 'total' objects, 'limit' (or
+    the params' limit) at a time, each page taking 'delay' seconds.
+    """
+    def __init__(self, total, limit=2, delay=0):
+        self.total = total
+        self.limit = limit
+        self.delay = delay
+        self.requests = []
+        self.session = self
+
+    def _build_url(self, *parts):
+        return 'http://vr' + parts[-1]
+
+    def get(self, url, params):
+        self.requests.append((url, params))
+        time.sleep(self.delay)
+
+        # Params from a 'next' URL come from parse_qs, as lists.
+        def param(name, default):
+            value = params.get(name, default)
+            return int(value[0] if isinstance(value, list) else value)
+        offset = param('offset', 0)
+        limit = param('limit', self.limit)
+        end = min(offset + limit, self.total)
+        next_url = None
+        if end < self.total:
+            next_url = '/api/v1/swarms/?limit=%d&offset=%d' % (limit, end)
+        return FakeResponse({
+            'meta': {'next': next_url, 'total_count': self.total},
+            'objects': [{'id': i} for i in range(offset, end)],
+        })
+
+
+def test_query_result_pages():
+    api = FakeAPI(5)
+    params = {'app': 'x'}
+    result = QueryResult(api, 'http://vr/api/v1/swarms/', params, limit=2)
+    assert [ob['id'] for ob in result] == [0, 1, 2, 3, 4]
+    assert params == {'app': 'x'}
+    assert len(api.requests) == 3
+    assert all(p['app'] == 'x' for url, p in api.requests)
+    assert len(result.page_times) == 3
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_query_result_prefetches():
+    api = FakeAPI(6)
+    result = QueryResult(api, 'http://vr/api/v1/swarms/', None)
+    assert next(result)['id'] == 0
+    # The second page is requested while the first is still being consumed.
+    assert wait_for(lambda: len(api.requests) == 2)
+    assert next(result)['id'] == 1
+    assert [ob['id'] for ob in result] == [2, 3, 4, 5]
+
+    api.requests = []
+    result = QueryResult(api, 'http://vr/api/v1/swarms/', None, prefetch=False)
+    next(result)
+    time.sleep(0.05)
+    assert len(api.requests) == 1
+
+
+def test_query_result_parallel(monkeypatch):
+    api = FakeAPI(20, limit=3)
+    failed = []
+    get = api.get
+    lock = threading.Lock()
+    started = []
+    all_started = threading.Event()
+
+    def flaky_get(url, params):
+        if 'offset' in params:
+            # Hold the first pages by offset until all four are in flight.
+            with lock:
+                started.append(params['offset'])
+                if len(started) == 4:
+                    all_started.set()
+            all_started.wait(2)
+        # Fail the first request for one page, to be retried.
+        if params.get('offset') == 9 and not failed:
+            failed.append(params)
+            raise requests.ConnectionError('reset')
+        return get(url, params)
+    api.get = flaky_get
+    monkeypatch.setattr(
+        QueryResult, 'retry_policy', rpc.RetryPolicy(attempts=2, base=0))
+
+    result = QueryResult(api, 'http://vr/api/v1/builds/', None, parallel=4)
+    assert [ob['id'] for ob in result] == list(range(20))
+    # The pages after the first were fetched 4 at a time.
+    assert all_started.is_set()
+    assert sorted(started[:4]) == [3, 6, 9, 12]
+    offsets = sorted(p.get('offset', 0) for url, p in api.requests)
+    assert offsets == [0, 3, 6, 9, 12, 15, 18]
+    assert failed
+
+
+class StreamingSession(object):
+    def __init__(self, body):
+        self.body = body
+        self.closed = False
+        self.urls = []
+
+    def get(self, url, stream=False):
+        assert stream
+        self.urls.append(url)
+        self.raw = io.BytesIO(self.body)
+        return self
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), 5):
+            yield self.body[i:i + 5]
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize('parser', ['ijson', 'fallback'])
+def test_iter_load(parser, monkeypatch):
+    if parser == 'ijson':
+        pytest.importorskip('ijson')
+    else:
+        monkeypatch.setattr(models.utils, 'ijson', None)
+    doc = {'meta': {'total_count': 2}, 'objects': [{'id': 1}, {'id': 2}]}
+    session = StreamingSession(json.dumps(doc).encode('utf-8'))
+    vr = Velociraptor.__new__(Velociraptor)
+    vr.base = 'http://vr/'
+    vr.session = session
+    objects = vr.iter_load('api/v1/swarms/')
+    assert next(objects) == {'id': 1}
+    assert not session.closed
+    assert list(objects) == [{'id': 2}]
+    assert session.closed
+    assert session.urls == ['http://vr/api/v1/swarms/?format=json&limit=9999']
+
+
+def test_query_result_close():
+    api = FakeAPI(20, limit=2, delay=0.05)
+    with QueryResult(
+            api, 'http://vr/api/v1/builds/', None, parallel=2) as result:
+        assert next(result)['id'] == 0
+    time.sleep(0.2)
+    # The first page, and at most the two in flight when it was closed.
+    assert len(api.requests) <= 3
+    assert list(result) == []
+    assert result._executor._shutdown
@@ -0,0 +1,90 @@
+import threading
+import time
+
+import pytest
+
+from vr.common.models import Host
+from vr.common.ports import NoFreePorts, PortAllocator
+from vr.common.tests import FakeRPC
+
+
+def test_from_procs():
+    procs = Host('h0', FakeRPC()).get_procs()
+    allocator = PortAllocator.from_procs(procs, low=5003, high=5005)
+    assert not allocator.is_free('h0', 5003)
+    assert allocator.is_free('h0', 5004)
+    assert allocator.free_count('h0') == 1
+    assert allocator.reserve() == ('h0', 5004)
+    with pytest.raises(NoFreePorts):
+        allocator.reserve()
+
+
+def test_reserve_least_used_host():
+    allocator = PortAllocator(low=5000, high=5010)
+    allocator.update_host('busy', range(5000, 5008))
+    allocator.update_host('idle', [5001])
+    assert allocator.reserve() == ('idle', 5000)
+    assert allocator.reserve() == ('idle', 5002)
+    assert allocator.reserve('busy') == ('busy', 5008)
+    assert allocator.free_count('idle') == 7
+
+
+def test_reservations_survive_refresh():
+    allocator = PortAllocator(low=5000, high=5010)
+    allocator.update_host('h', [])
+    host, port = allocator.reserve()
+    allocator.update_host('h', [])
+    assert not allocator.is_free('h', port)
+    allocator.release('h', port)
+    assert allocator.is_free('h', port)
+    # Once deployed, the port is used because of the proc.
+    host, port = allocator.reserve()
+    allocator.update_host('h', [port])
+    allocator.release('h', port)
+    assert not allocator.is_free('h', port)
+
+
+def test_reservations_expire():
+    allocator = PortAllocator(low=5000, high=5002, reservation_ttl=0.05)
+    allocator.update_host('h', [5000])
+    assert allocator.reserve() == ('h', 5001)
+    with pytest.raises(NoFreePorts):
+        allocator.reserve()
+    time.sleep(0.06)
+    # Expired without any update_host() call.
+    assert allocator.is_free('h', 5001)
+    assert allocator.free_count('h') == 1
+    assert allocator.reserve() == ('h', 5001)
+
+
+def test_concurrent_reservations_unique():
+    allocator = PortAllocator(low=5000, high=5100)
+    for i in range(4):
+        allocator.update_host('h%d' % i, [])
+    reserved = []
+
+    def grab():
+        for _ in range(50):
+            reserved.append(allocator.reserve())
+    threads = [threading.Thread(target=grab) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(reserved)) == 400
+    with pytest.raises(NoFreePorts):
+        allocator.reserve()
+
+
+@pytest.mark.usefixtures('skip_if_redis_missing')
+def test_redis_reservations(redisdb):
+    first = PortAllocator(low=5000, high=5010, redis=redisdb)
+    second = PortAllocator(low=5000, high=5010, redis=redisdb)
+    for allocator in first, second:
+        allocator.update_host('h', [5000])
+    assert first.reserve() == ('h', 5001)
+    # Taken in Redis by the first allocator, so skipped.
+    assert second.reserve() == ('h', 5002)
+    first.release('h', 5001)
+    assert not redisdb.exists('port_reservations:h:5001')
+    assert redisdb.ttl('port_reservations:h:5002') > 0
@@ -0,0 +1,95 @@
+import pytest
+
+from vr.common import proctable
+from vr.common.models import Host, Proc, CompactProc
+from vr.common.proctable import ProcTable
+from vr.common.tests import FakeRPC
+
+
+@pytest.fixture(params=['numpy', 'array'])
+def backend(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(proctable, 'numpy', None)
+    return request.param
+
+
+@pytest.fixture
+def table(backend):
+    procs = []
+    for i in range(3):
+        procs.extend(Host('h%d' % i, FakeRPC()).get_procs())
+    return ProcTable.from_procs(procs)
+
+
+def test_len_and_columns(table):
+    assert len(table) == 6
+    assert sorted(table.values('host')) == ['h0', 'h1', 'h2']
+    assert sorted(table.values('statename')) == ['FATAL', 'RUNNING']
+    assert sorted(table.column('port')) == [0, 0, 0, 5003, 5003, 5003]
+
+
+def test_where(table):
+    fatal = table.where(statename='FATAL')
+    assert len(fatal) == 3
+    assert set(p.app_name for p in fatal) == set(['node_example'])
+
+    subset = table.where(host=['h0', 'h2'], port=5003)
+    assert sorted(p.host.name for p in subset) == ['h0', 'h2']
+
+    assert len(table.where(app_name='nothing')) == 0
+    assert table.where() is table
+
+
+def test_where_callable(table):
+    high = table.where(port=lambda ports: [p > 5000 for p in ports])
+    assert len(high) == 3
+
+
+def test_count_by(table):
+    assert table.count_by('statename') == {'RUNNING': 3, 'FATAL': 3}
+    assert table.count_by('app_name', 'statename') == {
+        ('dummyproc', 'RUNNING'): 3,
+        ('node_example', 'FATAL'): 3,
+    }
+    assert table.where(host='h1').count_by('host', 'port') == {
+        ('h1', 0): 1,
+        ('h1', 5003): 1,
+    }
+
+
+def test_count_by_many_values(backend):
+    # Enough distinct values that the product of the columns' sizes is far
+    # beyond what could be allocated.
+    procs = []
+    for i in range(40):
+        host = Host('h%d' % i, FakeRPC())
+        procs.extend(host.get_procs())
+    table = ProcTable.from_procs(procs)
+    columns = ('host',) * 12
+    counts = table.count_by(*columns)
+    assert len(counts) == 40
+    assert counts[('h7',) * 12] == 2
+
+
+def test_count_by_numeric_keys_are_ints(table):
+    counts = table.count_by('port')
+    assert counts == {0: 3, 5003: 3}
+    assert all(type(port) is int for port in counts)
+    key, = table.where(host='h0', port=5003).count_by('host', 'port')
+    assert type(key[1]) is int
+
+
+def test_iteration_materializes_procs(table):
+    proc = next(iter(table.where(host='h1', statename='RUNNING')))
+    assert isinstance(proc, Proc)
+    assert proc.host.name == 'h1'
+    assert proc.name == 'dummyproc'
+
+
+def test_iteration_uses_proc_class(backend):
+    host = Host('somewhere', FakeRPC())
+    host.proc_class = CompactProc
+    table = ProcTable.from_procs(host.get_procs())
+    assert all(isinstance(p, CompactProc) for p in table)
@@ -0,0 +1,48 @@
+import io
+import json
+
+import pytest
+
+from vr.common import serialize
+from vr.common.models import Host, Proc, CompactProc
+from vr.common.tests import FakeRPC
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def backend(request, monkeypatch):
+    if request.param == 'orjson':
+        pytest.importorskip('orjson')
+    else:
+        monkeypatch.setattr(serialize, 'orjson', None)
+
+
+@pytest.fixture(params=[Proc, CompactProc])
+def procs(request, monkeypatch):
+    monkeypatch.setattr(Host, 'proc_class', request.param)
+    return Host('somewhere', FakeRPC()).get_procs()
+
+
+@pytest.mark.usefixtures('backend')
+def test_json_array_matches_as_dict(procs):
+    parsed = json.loads(''.join(serialize.iter_json(procs)))
+    assert parsed == [proc.as_dict() for proc in procs]
+
+
+@pytest.mark.usefixtures('backend')
+def test_json_lines(procs):
+    out = io.StringIO()
+    serialize.dump(procs, out, lines=True, batch_size=1)
+    lines = out.getvalue().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        proc.as_dict() for proc in procs]
+
+
+def test_subclass_as_dict_respected():
+    class TaggedProc(Proc):
+        def as_dict(self):
+            data = super(TaggedProc, self).as_dict()
+            data['tag'] = 'x'
+            return data
+    host = Host('somewhere', FakeRPC())
+    proc = TaggedProc(host, host.supervisor.process_info['dummyproc'])
+    assert serialize.proc_record(proc)['tag'] == 'x'
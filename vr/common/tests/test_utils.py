@@ -1,5 +1,11 @@
+import io
+import json
+
+import pytest
 import redis
 
+from vr.common import utils
+
 
 def test_parse_redis_url():
     r = redis.StrictRedis.from_url('redis://:password@localhost:6379/0')
@@ -13,3 +19,46 @@ def test_parse_redis_url():
     for k, v in expected.items():
         assert k in r.connection_pool.connection_kwargs.keys()
         assert v == r.connection_pool.connection_kwargs[k]
+
+
+listing = {
+    'meta': {'limit': 0, 'next': None, 'total_count': 3},
+    'objects': [
+        {'id': 1, 'name': 'brace } and ] and \u00e9', 'tags': []},
+        12.5,
+        {'nested': {'objects': [1, 2]}, 'n': 1234567},
+    ],
+    'after': 'the objects',
+}
+
+
+@pytest.mark.parametrize('size', [1, 3, 64, 100000])
+def test_iter_json_items(size):
+    raw = json.dumps(listing).encode('utf-8')
+    chunks = (raw[i:i + size] for i in range(0, len(raw), size))
+    items = utils.iter_json_items(chunks, 'objects')
+    assert list(items) == listing['objects']
+
+
+def test_iter_json_items_truncated():
+    with pytest.raises(ValueError):
+        list(utils.iter_json_items(['{"objects": [1, {"a"'], 'objects'))
+
+
+def test_stream_json_items_without_ijson(monkeypatch):
+    class Response(object):
+        def iter_content(self, chunk_size):
+            yield b'{"objects": [{"a": 1}, '
+            yield b'2]}'
+    monkeypatch.setattr(utils, 'ijson', None)
+    items = utils.stream_json_items(Response(), 'objects')
+    assert list(items) == [{'a': 1}, 2]
+
+
+def test_stream_json_items_with_ijson():
+    pytest.importorskip('ijson')
+
+    class Response(object):
+        raw = io.BytesIO(json.dumps(listing).encode('utf-8'))
+    items = utils.stream_json_items(Response(), 'objects')
+    assert list(items) == listing['objects']
@@ -10,7 +10,9 @@ import hashlib
 import errno
 import textwrap
 import contextlib
+import codecs
 import functools
+import json
 import warnings
 from pkg_resources import parse_version
 
@@ -22,6 +24,12 @@ except ImportError:
     # bypass import failure on Windows
     pass
 
+try:
+    import ijson
+except ImportError:
+    # optional dependency
+    ijson = None
+
 from six.moves import urllib
 
 import six
@@ -282,3 +290,113 @@ def get_lxc_overlayfs_config_fmt(version):
         "lowerdir=%(image_path)s,upperdir=%(proc_path)s,workdir=%(work_path)s "
         "0 0"
     )
+
+
+def iter_json_items(chunks, key):
+    """
+    Yield the items of the array at 'key' in a JSON object, decoding them one
+    at a time from an iterable of text or UTF-8 chunks, so that only one
+    item at a time (and any other top-level values) is held in memory.
+
+    >>> list(iter_json_items(['{"meta": {}, "obj', 'ects": [{"a": 1}, 2]}'],
+    ...                      'objects'))
+    [{'a': 1}, 2]
+    """
+    reader = _JSONChunkReader(chunks)
+    reader.expect('{')
+    while reader.peek() != '}':
+        name = reader.value()
+        reader.expect(':')
+        if name != key:
+            # Some other top-level value, like 'meta'
+            reader.value()
+        else:
+            reader.expect('[')
+            while reader.peek() != ']':
+                yield reader.value()
+                if reader.peek() == ',':
+                    reader.expect(',')
+            reader.expect(']')
+        if reader.peek() == ',':
+            reader.expect(',')
+
+
+def stream_json_items(response, key):
+    """
+    Yield the items of the array at 'key' in the JSON body of a requests
+    response made with stream=True.  Uses ijson when it is installed,
+    otherwise iter_json_items.
+    """
+    if ijson is not None:
+        response.raw.decode_content = True
+        return ijson.items(response.raw, key + '.item', use_float=True)
+    return iter_json_items(response.iter_content(chunk_size=65536), key)
+
+
+_json_delimiters = (',', ':', ']', '}')
+
+
+class _JSONChunkReader(object):
+    """
+    Decode JSON values one at a time from a stream of chunks.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decode = codecs.getincrementaldecoder('utf-8')().decode
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.done = False
+
+    def _more(self):
+        # Drop what's been consumed, and read another chunk.  Return False
+        # at the end of the stream.
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        for chunk in self.chunks:
+            if isinstance(chunk, bytes):
+                chunk = self.decode(chunk)
+            if chunk:
+                self.buf += chunk
+                return True
+        self.done = True
+        return False
+
+    def peek(self):
+        """
+        Return the next non-whitespace character.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                raise ValueError('Unexpected end of JSON')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected %r at %r' % (
+                char, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._more():
+                    raise
+                continue
+            # A number cut off by the end of a chunk (like '12.' of '12.5')
+            # still decodes, so only accept a value followed by a delimiter.
+            after = end
+            while after < len(self.buf) and self.buf[after].isspace():
+                after += 1
+            if not self.done and self.buf[after:after + 1] not in (
+                    _json_delimiters):
+                self._more()
+                continue
+            self.pos = end
+            return value